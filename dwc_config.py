@@ -64,6 +64,40 @@ def get_port(section, filename='altwfc.cfg'):
     return config.getint(section, 'Port')
 
 
+def get_int(section, option, default=None, filename='altwfc.cfg'):
+    """Return an integer option of the corresponding section.
+
+    Return default if the option isn't set.
+    """
+    config = ConfigParser.RawConfigParser(allow_no_value=True)
+    config.read(get_config_filename(filename))
+    if not config.has_option(section, option):
+        return default
+    return config.getint(section, option)
+
+
+def get_str(section, option, default=None, filename='altwfc.cfg'):
+    """Return a string option of the corresponding section.
+
+    Return default if the option isn't set.
+    """
+    config = ConfigParser.RawConfigParser(allow_no_value=True)
+    config.read(get_config_filename(filename))
+    if not config.has_option(section, option):
+        return default
+    return config.get(section, option) or ""
+
+
+def get_int_options(section, filename='altwfc.cfg'):
+    """Return the integer options of the corresponding section as a dict."""
+    config = ConfigParser.RawConfigParser(allow_no_value=True)
+    config.read(get_config_filename(filename))
+    if not config.has_section(section):
+        return {}
+    return {name: config.getint(section, name)
+            for name in config.options(section)}
+
+
 def get_logger(section, filename='altwfc.cfg'):
     """Return the logger of the corresponding section."""
     config = ConfigParser.RawConfigParser(allow_no_value=True)
@@ -0,0 +1,486 @@
+"""DWC Network Server Emulator
+
+    Copyright (C) 2014 polaris-
+    Copyright (C) 2015 Sepalani
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Backend server communication.
+
+The QR, server browser and NAT negotiation servers query the backend server
+for almost every packet they handle. Instead of using a multiprocessing
+manager, which pickles every call and proxies every result, requests are
+sent over a TCP connection as length-prefixed marshal frames:
+ - Request: (method, args, reply)
+ - Response: (ok, value)
+
+Requests from a connection are handled in order so a client can send several
+requests before reading their responses. Requests sent with reply set to
+False don't get any response, which is used for heartbeats.
+
+marshal isn't safe with untrusted data. Connections start with a handshake:
+the server sends a random challenge which the client answers with its
+HMAC-SHA256 keyed with the AuthKey of [GameSpyManager]. Frames are only read
+from authenticated clients. The backend is only meant to be reachable by the
+other servers, keep it bound to localhost or set an AuthKey.
+"""
+
+import hashlib
+import hmac
+import logging
+import marshal
+import os
+import socket
+import struct
+import threading
+import time
+import traceback
+import Queue
+import SocketServer
+
+import dwc_config
+
+# Frames bigger than this are considered corrupted
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+CHALLENGE_SIZE = 32
+# Clients have this many seconds to answer the challenge
+HANDSHAKE_TIMEOUT = 10
+# Delays between reconnection attempts, in seconds
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+
+
+class BackendError(Exception):
+    pass
+
+
+class BackendConnectionError(BackendError):
+    pass
+
+
+def pack_frame(obj):
+    """Serialize obj into a length-prefixed frame."""
+    data = marshal.dumps(obj, 2)
+    return struct.pack("<I", len(data)) + data
+
+
+def read_frame(rfile):
+    """Read a frame from a file-like object.
+
+    Return None if the connection was closed.
+    """
+    header = rfile.read(4)
+    if len(header) < 4:
+        return None
+
+    size = struct.unpack("<I", header)[0]
+    if size > MAX_FRAME_SIZE:
+        raise BackendError("Frame too big (%d bytes)" % size)
+
+    data = rfile.read(size)
+    if len(data) < size:
+        return None
+
+    return marshal.loads(data)
+
+
+def get_auth_key():
+    """Return the shared secret of the backend connections."""
+    return dwc_config.get_str('GameSpyManager', 'AuthKey', "")
+
+
+def answer_challenge(auth_key, challenge):
+    """Return the answer to a handshake challenge."""
+    return hmac.new(auth_key, challenge, hashlib.sha256).digest()
+
+
+class BackendRequestHandler(SocketServer.StreamRequestHandler):
+    """Handle the requests of a backend client."""
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def authenticate(self):
+        """Check that the client knows the shared secret."""
+        challenge = os.urandom(CHALLENGE_SIZE)
+
+        self.connection.settimeout(HANDSHAKE_TIMEOUT)
+        try:
+            self.wfile.write(challenge)
+            answer = self.rfile.read(hashlib.sha256().digest_size)
+        except socket.error:
+            return False
+        self.connection.settimeout(None)
+
+        expected = answer_challenge(self.server.auth_key, challenge)
+        if not hmac.compare_digest(answer, expected):
+            return False
+
+        self.wfile.write('\x01')
+        return True
+
+    def handle(self):
+        methods = self.server.methods
+        logger = self.server.logger
+
+        if not self.authenticate():
+            logger.log(logging.WARNING,
+                       "Authentication failed for %s:%d",
+                       self.client_address[0], self.client_address[1])
+            return
+
+        while True:
+            try:
+                request = read_frame(self.rfile)
+                if request is None:
+                    break
+
+                method, args, reply = request
+            except (BackendError, EOFError, ValueError, TypeError):
+                logger.log(logging.ERROR,
+                           "Invalid request from %s:%d: %s",
+                           self.client_address[0], self.client_address[1],
+                           traceback.format_exc())
+                break
+
+            try:
+                response = (True, methods[method](*args))
+            except:
+                logger.log(logging.ERROR,
+                           "Failed to handle %s: %s",
+                           method, traceback.format_exc())
+                response = (False, traceback.format_exc())
+
+            if reply:
+                self.wfile.write(pack_frame(response))
+
+
+class BackendServer(SocketServer.ThreadingTCPServer):
+    """Serve the methods of the backend server."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, methods, logger, auth_key=None):
+        SocketServer.ThreadingTCPServer.__init__(self, address,
+                                                 BackendRequestHandler)
+        self.methods = methods
+        self.logger = logger
+        self.auth_key = get_auth_key() if auth_key is None else auth_key
+
+        if not self.auth_key and \
+           address[0] not in ("127.0.0.1", "localhost"):
+            logger.log(logging.WARNING,
+                       "The backend accepts connections on %s without"
+                       " AuthKey, anyone reaching it can use it!",
+                       address[0])
+
+
+class BackendMethods(object):
+    """Methods of the backend server, implemented on top of call."""
+
+    def get_server_list(self):
+        return self.call("get_server_list")
+
+    def get_generation(self, gameid):
+        return self.call("get_generation", gameid)
+
+    def find_servers(self, gameid, filters, fields, max_count):
+        return self.call("find_servers", gameid, filters, fields, max_count)
+
+    def find_server_by_address(self, ip, port, gameid=None):
+        return self.call("find_server_by_address", ip, port, gameid)
+
+    def find_server_by_local_address(self, publicip, localaddr, gameid=None):
+        return self.call("find_server_by_local_address",
+                         publicip, localaddr, gameid)
+
+    def update_server_list(self, gameid, session, value, console):
+        return self.call("update_server_list", gameid, session, value,
+                         console)
+
+    def delete_server(self, gameid, session):
+        return self.call("delete_server", gameid, session)
+
+    def add_natneg_server(self, cookie, server):
+        return self.call("add_natneg_server", cookie, server)
+
+    def get_natneg_server(self, cookie):
+        return self.call("get_natneg_server", cookie)
+
+    def delete_natneg_server(self, cookie):
+        return self.call("delete_natneg_server", cookie)
+
+    def get_natneg_stats(self):
+        return self.call("get_natneg_stats")
+
+    def set_natneg_report(self, report):
+        return self.call("set_natneg_report", report)
+
+    def get_natneg_report(self):
+        return self.call("get_natneg_report")
+
+
+class Backoff(object):
+    """Delay between connection attempts, doubled after each failure."""
+
+    def __init__(self, delay=RECONNECT_DELAY, max_delay=RECONNECT_MAX_DELAY):
+        self.initial_delay = delay
+        self.max_delay = max_delay
+        self.delay = delay
+        self.next_attempt = 0
+
+    def check(self):
+        """Raise BackendConnectionError until the next attempt is due."""
+        remaining = self.next_attempt - time.time()
+        if remaining > 0:
+            raise BackendConnectionError(
+                "Backend unavailable, next connection attempt in %.1f"
+                " seconds" % remaining
+            )
+
+    def failed(self):
+        self.next_attempt = time.time() + self.delay
+        self.delay = min(self.delay * 2, self.max_delay)
+
+    def succeeded(self):
+        self.delay = self.initial_delay
+        self.next_attempt = 0
+
+
+class BackendClient(BackendMethods):
+    """Connection to the backend server.
+
+    The connection can be shared between threads. If it's lost, it's opened
+    again by the next call, attempts are spaced by backoff.
+    """
+
+    def __init__(self, address=None, backoff=None):
+        if address is None:
+            address = dwc_config.get_ip_port('GameSpyManager')
+
+        self.address = address
+        self.auth_key = get_auth_key()
+        self.backoff = Backoff() if backoff is None else backoff
+        self.socket = None
+        self.rfile = None
+        self.lock = threading.Lock()
+        self.queued = []
+
+        # Number of connections opened, the backend might have lost its
+        # state when there's a new one
+        self.connections = 0
+
+    def open(self):
+        """Connect and authenticate to the backend server."""
+        self.socket = socket.create_connection(self.address)
+        try:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.rfile = self.socket.makefile('rb')
+
+            challenge = self.rfile.read(CHALLENGE_SIZE)
+            if len(challenge) < CHALLENGE_SIZE:
+                raise BackendConnectionError(
+                    "Connection to the backend was closed"
+                )
+
+            self.socket.sendall(answer_challenge(self.auth_key, challenge))
+            if self.rfile.read(1) != '\x01':
+                raise BackendConnectionError(
+                    "Backend authentication failed, check AuthKey"
+                )
+        except:
+            self.close()
+            raise
+
+        self.connections += 1
+
+    def connect(self, timeout=0):
+        """Connect to the backend server.
+
+        Retry for up to timeout seconds if the backend isn't running yet.
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self.open()
+                break
+            except socket.error:
+                if time.time() >= deadline:
+                    raise
+                time.sleep(0.5)
+
+        self.backoff.succeeded()
+
+    def reconnect(self):
+        """Connect again if the connection was lost.
+
+        The lock must be held if the client is shared.
+        """
+        if self.socket is not None:
+            return
+
+        self.backoff.check()
+        try:
+            self.open()
+        except (socket.error, BackendError) as e:
+            self.backoff.failed()
+            raise BackendConnectionError(
+                "Failed to connect to the backend: %s" % e
+            )
+
+        self.backoff.succeeded()
+
+    def close(self):
+        if self.socket is not None:
+            self.rfile.close()
+            self.socket.close()
+            self.socket = None
+            self.rfile = None
+
+    def call_many(self, requests):
+        """Send several (method, args) requests at once and return their
+        results."""
+        data = ''.join(pack_frame((method, tuple(args), True))
+                       for method, args in requests)
+
+        with self.lock:
+            self.reconnect()
+            try:
+                self.socket.sendall(data)
+                responses = [read_frame(self.rfile) for _ in requests]
+            except (socket.error, BackendError, EOFError, ValueError) as e:
+                # The responses can't be matched to the requests anymore
+                self.close()
+                raise BackendConnectionError(
+                    "Connection to the backend was lost: %s" % e
+                )
+
+            if None in responses:
+                self.close()
+                raise BackendConnectionError(
+                    "Connection to the backend was closed"
+                )
+
+        results = []
+        for response in responses:
+            ok, value = response
+            if not ok:
+                raise BackendError(value)
+
+            results.append(value)
+
+        return results
+
+    def call(self, method, *args):
+        """Call a backend method and return its result."""
+        return self.call_many([(method, args)])[0]
+
+    def send(self, method, *args):
+        """Call a backend method without waiting for its result."""
+        data = pack_frame((method, args, False))
+
+        with self.lock:
+            self.send_data(data)
+
+    def queue(self, method, *args):
+        """Queue a call without result until the next flush.
+
+        The queue isn't shared between threads, it must be used by a single
+        thread.
+        """
+        self.queued.append(pack_frame((method, args, False)))
+
+    def flush(self):
+        """Send the queued calls at once."""
+        if not self.queued:
+            return
+
+        data = ''.join(self.queued)
+        self.queued = []
+
+        with self.lock:
+            self.send_data(data)
+
+    def send_data(self, data):
+        """Send data to the backend, the lock must be held."""
+        self.reconnect()
+        try:
+            self.socket.sendall(data)
+        except socket.error as e:
+            self.close()
+            raise BackendConnectionError(
+                "Connection to the backend was lost: %s" % e
+            )
+
+
+class BackendClientPool(BackendMethods):
+    """Pool of backend connections.
+
+    Each call uses its own connection so threads don't wait for each other.
+    Connections are created when needed and at most size of them are kept
+    once they're released.
+    """
+
+    def __init__(self, size=10, address=None):
+        self.size = size
+        self.address = address
+        self.clients = Queue.Queue()
+        # Shared by the connections so a backend that's down isn't retried
+        # by every call
+        self.backoff = Backoff()
+
+    def acquire(self):
+        try:
+            return self.clients.get_nowait()
+        except Queue.Empty:
+            client = BackendClient(self.address, self.backoff)
+            client.reconnect()
+            return client
+
+    def release(self, client):
+        if self.clients.qsize() < self.size:
+            self.clients.put(client)
+        else:
+            client.close()
+
+    def call_many(self, requests):
+        client = self.acquire()
+        try:
+            results = client.call_many(requests)
+        except (socket.error, BackendConnectionError):
+            # Don't reuse broken connections
+            client.close()
+            raise
+        except:
+            self.release(client)
+            raise
+
+        self.release(client)
+        return results
+
+    def call(self, method, *args):
+        return self.call_many([(method, args)])[0]
+
+    def send(self, method, *args):
+        client = self.acquire()
+        try:
+            client.send(method, *args)
+        except (socket.error, BackendConnectionError):
+            client.close()
+            raise
+
+        self.release(client)
@@ -25,6 +25,10 @@ import itertools
 import json
 import time
 import logging
+import threading
+import traceback
+import Queue
+from collections import OrderedDict
 from contextlib import closing
 
 import other.utils as utils
@@ -591,15 +595,27 @@ class GamespyDatabase(object):
 
     # Buddy functions
     def add_buddy(self, userProfileId, buddyProfileId):
-        now = int(time.time())
+        """Add a buddy and return the added row."""
+        buddy = {
+            'userProfileId': userProfileId,
+            'buddyProfileId': buddyProfileId,
+            'time': int(time.time()),
+            'status': 0,  # status == 0 -> not authorized
+            'notified': 0,
+            'gameid': "",
+            'blocked': 0,
+        }
 
-        # status == 0 -> not authorized
         with Transaction(self.conn) as tx:
             tx.nonquery(
                 "INSERT INTO buddies VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (userProfileId, buddyProfileId, now, 0, 0, "", 0)
+                (buddy['userProfileId'], buddy['buddyProfileId'],
+                 buddy['time'], buddy['status'], buddy['notified'],
+                 buddy['gameid'], buddy['blocked'])
             )
 
+        return buddy
+
     def auth_buddy(self, userProfileId, buddyProfileId):
         # status == 1 -> authorized
         with Transaction(self.conn) as tx:
@@ -722,3 +738,85 @@ class GamespyDatabase(object):
                 (profileid, dindex, ptype)
             )
         return self.get_dict(row)
+
+
+class ProfileCache(object):
+    """Read-through cache of profile data used by the QR server.
+
+    Entries are {"console", "userid", "ingamesn"} dicts, where the values
+    are None when unknown. get() never waits for the database, missing
+    entries are loaded by a background thread with its own connection and
+    get() returns None until they're loaded. Entries expire after ttl
+    seconds and the least recently used ones are dropped past size entries.
+    """
+
+    def __init__(self, ttl=300, size=10000, filename='gpcm.db'):
+        self.ttl = ttl
+        self.size = size
+        self.filename = filename
+
+        self.entries = OrderedDict()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+
+        thread = threading.Thread(target=self.worker)
+        thread.daemon = True
+        thread.start()
+
+    def get(self, profileid):
+        """Return the cached profile data or schedule its loading."""
+        profileid = int(profileid)
+
+        with self.lock:
+            entry = self.entries.pop(profileid, None)
+            if entry is not None and entry[0] > time.time():
+                # Move it to the end, the least recently used are first
+                self.entries[profileid] = entry
+                return entry[1]
+
+            if profileid not in self.pending:
+                self.pending.add(profileid)
+                self.queue.put(profileid)
+
+        return None
+
+    def load(self, db, profileid):
+        entry = {"console": None, "userid": None, "ingamesn": None}
+
+        profile = db.get_profile_from_profileid(profileid)
+        if not profile:
+            return entry
+
+        entry["console"] = profile.get("console")
+        entry["userid"] = profile.get("userid")
+
+        naslogin = db.get_nas_login_from_userid(entry["userid"])
+        if naslogin and "ingamesn" in naslogin:
+            # Convert to string from unicode (which is just a base64 string
+            # anyway)
+            entry["ingamesn"] = str(naslogin["ingamesn"])
+
+        return entry
+
+    def worker(self):
+        db = GamespyDatabase(self.filename)
+
+        while True:
+            profileid = self.queue.get()
+
+            try:
+                entry = self.load(db, profileid)
+            except:
+                logger.log(logging.ERROR,
+                           "Failed to load profile %d: %s",
+                           profileid, traceback.format_exc())
+                entry = None
+
+            with self.lock:
+                self.pending.discard(profileid)
+
+                if entry is not None:
+                    self.entries[profileid] = (time.time() + self.ttl, entry)
+                    if len(self.entries) > self.size:
+                        self.entries.popitem(last=False)
@@ -0,0 +1,142 @@
+"""DWC Network Server Emulator
+
+    Copyright (C) 2014 polaris-
+    Copyright (C) 2015 Sepalani
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+NAT negotiation timelines.
+
+The NAT negotiation server records when each step of a negotiation happens
+(first PREINIT/INIT of each client, CONNECT sent, CONNECT_ACK and REPORT of
+each client). Once a client reports the result, the time it took to connect
+is kept per game to compute percentiles.
+"""
+
+import time
+from collections import OrderedDict, deque
+
+# Percentiles of the time to connect reported for each game
+PERCENTILES = (50, 90, 99)
+
+
+class NatNegTimelines(object):
+    """Timelines of the last NAT negotiations.
+
+    At most size timelines are kept, the oldest ones are dropped first. The
+    last samples times to connect are kept for each game.
+
+    It isn't thread-safe, it must be used by the reactor's thread.
+    """
+
+    def __init__(self, size=4096, samples=1000):
+        self.size = size
+        self.samples = samples
+
+        # cookie -> timeline, oldest first
+        self.timelines = OrderedDict()
+        self.games = {}
+
+    def get_timeline(self, cookie):
+        timeline = self.timelines.get(cookie)
+        if timeline is None:
+            if len(self.timelines) >= self.size:
+                _, oldest = self.timelines.popitem(last=False)
+                self.finish(oldest)
+
+            timeline = {
+                "gameid": None,
+                "start": time.time(),
+                "events": {},
+                "reported": False,
+            }
+            self.timelines[cookie] = timeline
+
+        return timeline
+
+    def get_game(self, gameid):
+        game = self.games.get(gameid)
+        if game is None:
+            game = {
+                "connected": 0,
+                "failed": 0,
+                "unreported": 0,
+                "times": deque(maxlen=self.samples),
+            }
+            self.games[gameid] = game
+
+        return game
+
+    def event(self, cookie, name, client_index=None, gameid=None):
+        """Record the first time name happened in the negotiation."""
+        timeline = self.get_timeline(cookie)
+        if gameid and timeline["gameid"] is None:
+            timeline["gameid"] = gameid
+        timeline["events"].setdefault((name, client_index), time.time())
+
+    def report(self, cookie, client_index, success, gameid=None):
+        """Record the result reported by a client.
+
+        Only the first report of a negotiation is counted.
+        """
+        timeline = self.get_timeline(cookie)
+        self.event(cookie, "report", client_index, gameid)
+        if timeline["reported"]:
+            return
+
+        timeline["reported"] = True
+        game = self.get_game(timeline["gameid"] or "unknown")
+        if success:
+            game["connected"] += 1
+            game["times"].append(
+                timeline["events"][("report", client_index)] -
+                timeline["start"]
+            )
+        else:
+            game["failed"] += 1
+
+    def finish(self, timeline):
+        """Count a negotiation which is dropped without any report."""
+        if not timeline["reported"] and timeline["gameid"] is not None:
+            self.get_game(timeline["gameid"])["unreported"] += 1
+
+    def expire(self, cookie):
+        """Drop the timeline of an expired negotiation."""
+        timeline = self.timelines.pop(cookie, None)
+        if timeline is not None:
+            self.finish(timeline)
+
+    def get_report(self):
+        """Return the counts and time to connect percentiles of each game.
+
+        Times are in milliseconds.
+        """
+        report = {}
+        for gameid, game in self.games.items():
+            times = sorted(game["times"])
+            entry = {
+                "connected": game["connected"],
+                "failed": game["failed"],
+                "unreported": game["unreported"],
+            }
+            for percentile in PERCENTILES:
+                if times:
+                    index = min(len(times) - 1,
+                                len(times) * percentile // 100)
+                    entry["p%d" % percentile] = int(times[index] * 1000)
+                else:
+                    entry["p%d" % percentile] = None
+            report[gameid] = entry
+
+        return report
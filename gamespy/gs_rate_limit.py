@@ -0,0 +1,137 @@
+"""DWC Network Server Emulator
+
+    Copyright (C) 2014 polaris-
+    Copyright (C) 2015 Sepalani
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Per IP rate limiting of UDP packets.
+
+Every packet handled by the QR and NAT negotiation servers can create a
+session or query the backend. Packets are checked against a token bucket of
+their source IP before being handled so a single client flooding the server
+doesn't slow down everyone else.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+
+import dwc_config
+
+
+class RateLimiter(object):
+    """Token buckets keyed by IP.
+
+    A bucket holds up to burst tokens and is refilled with rate tokens per
+    second, each packet uses a token. Only the size most recently seen IPs
+    are tracked, an evicted IP starts again with a full bucket.
+
+    It isn't thread-safe, it must be used by the thread receiving the
+    packets.
+    """
+
+    def __init__(self, logger, rate=50, burst=200, size=65536,
+                 stats_interval=60):
+        self.logger = logger
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.size = size
+        self.stats_interval = stats_interval
+
+        # IP -> (tokens, last update), least recently seen first
+        self.buckets = OrderedDict()
+
+        # Metrics
+        self.allowed = 0
+        self.dropped = 0
+        self.evicted = 0
+        self.limited = set()
+        self.next_stats = time.time() + stats_interval
+
+    def allow(self, ip):
+        """Use a token of ip, return False if the packet must be dropped."""
+        now = time.time()
+
+        bucket = self.buckets.pop(ip, None)
+        if bucket is None:
+            tokens = self.burst
+            if len(self.buckets) >= self.size:
+                self.buckets.popitem(last=False)
+                self.evicted += 1
+        else:
+            tokens = min(self.burst,
+                         bucket[0] + (now - bucket[1]) * self.rate)
+
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+            self.allowed += 1
+        else:
+            self.dropped += 1
+            if ip not in self.limited and len(self.limited) < self.size:
+                self.limited.add(ip)
+                self.logger.log(logging.WARNING,
+                                "Rate limiting packets from %s...", ip)
+
+        # Move it to the end, the least recently seen are first
+        self.buckets[ip] = (tokens, now)
+
+        if now >= self.next_stats:
+            self.log_stats()
+
+        return allowed
+
+    def get_stats(self):
+        """Return the rate limiter metrics."""
+        return {
+            "tracked": len(self.buckets),
+            "allowed": self.allowed,
+            "dropped": self.dropped,
+            "evicted": self.evicted,
+            "limited": len(self.limited),
+        }
+
+    def log_stats(self):
+        """Log the metrics of the last interval and reset them."""
+        stats = self.get_stats()
+        if stats["dropped"]:
+            self.logger.log(logging.INFO,
+                            "Rate limiter: %d packets allowed, %d dropped"
+                            " from %d IPs, %d IPs tracked, %d evicted",
+                            stats["allowed"], stats["dropped"],
+                            stats["limited"], stats["tracked"],
+                            stats["evicted"])
+
+        self.allowed = 0
+        self.dropped = 0
+        self.evicted = 0
+        self.limited = set()
+        self.next_stats = time.time() + self.stats_interval
+
+
+def create_rate_limiter(section, logger):
+    """Return the rate limiter configured in section.
+
+    Return None if rate limiting is disabled.
+    """
+    rate = dwc_config.get_int(section, 'RateLimit', 50)
+    if not rate:
+        return None
+
+    return RateLimiter(
+        logger, rate,
+        dwc_config.get_int(section, 'RateLimitBurst', rate * 4),
+        dwc_config.get_int(section, 'RateLimitSize', 65536)
+    )
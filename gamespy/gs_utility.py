@@ -22,8 +22,11 @@
 
 import base64
 import hashlib
+import string
 import time
 
+from itertools import cycle, izip
+
 import other.utils as utils
 
 
@@ -46,48 +49,67 @@ def generate_secret_keys(filename="gslist.cfg"):
     return secret_key_list
 
 
-def base64_encode(input):
-    """Encode input in base64 using GameSpy variant.
+# GameSpy uses a slightly modified version of base64 which replaces
+# +/= with []_
+BASE64_ENCODE_TABLE = string.maketrans('+/=', '[]_')
+BASE64_DECODE_TABLE = string.maketrans('[]_', '+/=')
 
-    GameSpy uses a slightly modified version of base64 which replaces
-    +/= with []_
-    """
-    output = base64.b64encode(input).replace('+', '[') \
-                                    .replace('/', ']') \
-                                    .replace('=', '_')
-    return output
+
+def base64_encode(input):
+    """Encode input in base64 using GameSpy variant."""
+    return base64.b64encode(input).translate(BASE64_ENCODE_TABLE)
 
 
 def base64_decode(input):
     """Decode input in base64 using GameSpy variant."""
-    output = base64.b64decode(input.replace('[', '+')
-                                   .replace(']', '/')
-                                   .replace('_', '='))
-    return output
+    return base64.b64decode(input.translate(BASE64_DECODE_TABLE))
+
+
+# Secret keys are per game so there are only a few different key schedules
+RC4_KEY_SCHEDULES_MAX = 1024
+rc4_key_schedules = {}
+
+
+def rc4_key_schedule(key):
+    """Return the RC4 state after the key-scheduling algorithm.
+
+    The state is cached per key and must not be modified.
+    """
+    S = rc4_key_schedules.get(key)
+    if S is not None:
+        return S
+
+    key_bytes = bytearray(key)
+    key_len = len(key_bytes)
+    S = range(0x100)
+
+    j = 0
+    for i in xrange(0x100):
+        # Get index to swap with
+        j = (j + S[i] + key_bytes[i % key_len]) & 0xff
+
+        # Perform swap
+        S[i], S[j] = S[j], S[i]
+
+    if len(rc4_key_schedules) >= RC4_KEY_SCHEDULES_MAX:
+        rc4_key_schedules.clear()
+    rc4_key_schedules[key] = S
+    return S
 
 
 def rc4_encrypt(_key, _data):
     """
     Tetris DS overlay 10 @ 0216E9B8
     """
-    key = bytearray(_key)
     data = bytearray(_data)
 
-    if len(key) == 0:
+    if len(_key) == 0:
         # This shouldn't happen but it apparently can on a rare occasion.
         # Key should always be set.
         return
 
     # Key-scheduling algorithm
-    S = range(0x100)
-
-    j = 0
-    for i in range(0x100):
-        # Get index to swap with
-        j = (j + S[i] + key[i % len(key)]) & 0xff
-
-        # Perform swap
-        S[i], S[j] = S[j], S[i]
+    S = rc4_key_schedule(bytes(_key))[:]
 
     # Pseudo-random generation algorithm + encryption
     i = 0
@@ -95,11 +117,15 @@ def rc4_encrypt(_key, _data):
     for x, val in enumerate(data):
         # Modified RC4?
         i = (i + 1 + val) & 0xff
-        j = (j + S[i]) & 0xff
+        si = S[i]
+        j = (j + si) & 0xff
+        sj = S[j]
 
-        S[i], S[j] = S[j], S[i]
+        # Perform swap
+        S[i] = sj
+        S[j] = si
 
-        data[x] ^= S[(S[i] + S[j]) & 0xff]
+        data[x] = val ^ S[(si + sj) & 0xff]
 
     return data
 
@@ -120,6 +146,26 @@ def prepare_rc4_base64(_key, _data):
     return base64.b64encode(buffer(data))
 
 
+GAMESTATS_KEY = bytearray(b"GameSpy3D")
+
+
+def gamestats_crypt(data):
+    """Encrypt/decrypt a gamestats message.
+
+    The message is XORed with GAMESTATS_KEY up to the \\final\\ marker.
+    """
+    output = bytearray(data.encode("ascii"))
+
+    end = output.find("\\final\\")
+    if end == -1:
+        end = len(output)
+
+    output[:end] = bytearray(
+        a ^ b for a, b in izip(output[:end], cycle(GAMESTATS_KEY))
+    )
+    return output
+
+
 def parse_authtoken(authtoken, db):
     """Get the login data from nas.nintendowifi.net/ac from an authtoken"""
     return db.get_nas_login(authtoken)
@@ -332,20 +378,41 @@ class EncTypeX:
         self.func4(encxkey, validate, 8)
         return data
 
+    # Smallest 2^n - 1 mask covering each possible count of func5
+    masks = [(1 << cnt.bit_length()) - 1 for cnt in range(256)]
+
     def func4(self, encxkey, id, idlen):
+        """Key schedule, func5 is inlined since it's called 256 times."""
         if idlen < 1:
             return
 
-        for i in range(256):
-            encxkey[i] = i
+        encxkey[:256] = bytearray(range(256))
+        masks = self.masks
 
         n1 = 0
         n2 = 0
-        for i in range(255, -1, -1):
-            t1, n1, n2 = self.func5(encxkey, i, id, idlen, n1, n2)
-            t2 = encxkey[i]
-            encxkey[i] = encxkey[t1]
-            encxkey[t1] = t2
+        for cnt in range(255, 0, -1):
+            # func5
+            mask = masks[cnt]
+            i = 0
+            while True:
+                n1 = encxkey[n1 & 0xff] + id[n2]
+                n2 += 1
+
+                if n2 >= idlen:
+                    n2 = 0
+                    n1 += idlen
+
+                tmp = n1 & mask
+
+                i += 1
+                if i > 11:
+                    tmp %= cnt
+
+                if tmp <= cnt:
+                    break
+
+            encxkey[cnt], encxkey[tmp] = encxkey[tmp], encxkey[cnt]
 
         encxkey[256] = encxkey[1]
         encxkey[257] = encxkey[3]
@@ -357,12 +424,7 @@ class EncTypeX:
         if cnt == 0:
             return 0, n1, n2
 
-        mask = 1
-        doLoop = True
-        if cnt > 1:
-            while doLoop:
-                mask = (mask << 1) + 1
-                doLoop = mask < cnt
+        mask = self.masks[cnt]
 
         i = 0
         tmp = 0
@@ -386,118 +448,48 @@ class EncTypeX:
         return tmp, n1, n2
 
     def func6(self, encxkey, data, data_len):
-        for i in range(data_len):
-            data[i] = self.func7(encxkey, data[i])
-        return len(data)
-
-    def func7(self, encxkey, d):
-        a = encxkey[256]
-        b = encxkey[257]
-        c = encxkey[a]
-        encxkey[256] = (a + 1) & 0xff
-        encxkey[257] = (b + c) & 0xff
-
-        a = encxkey[260]
-        b = encxkey[257]
-        b = encxkey[b]
-        c = encxkey[a]
-        encxkey[a] = b
-
-        a = encxkey[259]
-        b = encxkey[257]
-        a = encxkey[a]
-        encxkey[b] = a
-
-        a = encxkey[256]
-        b = encxkey[259]
-        a = encxkey[a]
-        encxkey[b] = a
-
-        a = encxkey[256]
-        encxkey[a] = c
-
-        b = encxkey[258]
-        a = encxkey[c]
-        c = encxkey[259]
-        b = (a + b) & 0xff
-        encxkey[258] = b
-
-        a = b
-        c = encxkey[c]
-        b = encxkey[257]
-        b = encxkey[b]
-        a = encxkey[a]
-        c = (b + c) & 0xff
-        b = encxkey[260]
-        b = encxkey[b]
-        c = (b + c) & 0xff
-        b = encxkey[c]
-        c = encxkey[256]
-        c = encxkey[c]
-        a = (a + c) & 0xff
-        c = encxkey[b]
-        b = encxkey[a]
-        encxkey[260] = d
-
-        c ^= b ^ d
-        encxkey[259] = c
-
-        return c
+        return self.crypt(encxkey, data, data_len, False)
 
     def func6e(self, encxkey, data, data_len):
-        for i in range(data_len):
-            data[i] = self.func7e(encxkey, data[i])
-        return len(data)
+        return self.crypt(encxkey, data, data_len, True)
+
+    def crypt(self, encxkey, data, data_len, encrypt):
+        """func7 (decryption) and func7e (encryption) applied on each byte.
+
+        The state stored at the end of encxkey is kept in local variables
+        during the loop since it's used several times per byte.
+        """
+        k = encxkey
+        s256, s257, s258, s259, s260 = k[256:261]
+
+        for i in xrange(data_len):
+            d = data[i]
 
-    def func7e(self, encxkey, d):
-        a = encxkey[256]
-        b = encxkey[257]
-        c = encxkey[a]
-        encxkey[256] = (a + 1) & 0xff
-        encxkey[257] = (b + c) & 0xff
-
-        a = encxkey[260]
-        b = encxkey[257]
-        b = encxkey[b]
-        c = encxkey[a]
-        encxkey[a] = b
-
-        a = encxkey[259]
-        b = encxkey[257]
-        a = encxkey[a]
-        encxkey[b] = a
-
-        a = encxkey[256]
-        b = encxkey[259]
-        a = encxkey[a]
-        encxkey[b] = a
-
-        a = encxkey[256]
-        encxkey[a] = c
-
-        b = encxkey[258]
-        a = encxkey[c]
-        c = encxkey[259]
-        b = (a + b) & 0xff
-        encxkey[258] = b
-
-        a = b
-        c = encxkey[c]
-        b = encxkey[257]
-        b = encxkey[b]
-        a = encxkey[a]
-        c = (b + c) & 0xff
-        b = encxkey[260]
-        b = encxkey[b]
-        c = (b + c) & 0xff
-        b = encxkey[c]
-        c = encxkey[256]
-        c = encxkey[c]
-        a = (a + c) & 0xff
-        c = encxkey[b]
-        b = encxkey[a]
-        c ^= b ^ d
-        encxkey[260] = c
-        encxkey[259] = d
-
-        return c
+            a = s256
+            c = k[a]
+            s256 = (a + 1) & 0xff
+            s257 = (s257 + c) & 0xff
+
+            c = k[s260]
+            k[s260] = k[s257]
+            k[s257] = k[s259]
+            k[s259] = k[s256]
+            k[s256] = c
+
+            s258 = (k[c] + s258) & 0xff
+
+            b = k[(k[s257] + k[s259] + k[s260]) & 0xff]
+            a = (k[s258] + k[s256]) & 0xff
+            c = k[b] ^ k[a] ^ d
+
+            if encrypt:
+                s260 = c
+                s259 = d
+            else:
+                s260 = d
+                s259 = c
+
+            data[i] = c
+
+        k[256:261] = bytearray([s256, s257, s258, s259, s260])
+        return len(data)
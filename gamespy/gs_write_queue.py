@@ -0,0 +1,168 @@
+"""DWC Network Server Emulator
+
+    Copyright (C) 2014 polaris-
+    Copyright (C) 2015 Sepalani
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Delayed UDP replies.
+
+The QR and NAT negotiation servers don't reply right away, packets are sent
+after a short delay. Pending packets are kept in a heap ordered by due time
+and sent by a single thread.
+"""
+
+import heapq
+import itertools
+import logging
+import socket
+import threading
+import time
+import traceback
+
+
+class WriteQueue(object):
+    """Send packets after a delay from a single thread.
+
+    Items are (data, address) or (data, address, socket) tuples. The default
+    socket is used when the item doesn't have one.
+    """
+
+    def __init__(self, logger, socket=None, delay=0.05, stats_interval=60):
+        self.logger = logger
+        self.socket = socket
+        self.delay = delay
+        self.stats_interval = stats_interval
+
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+        # Metrics
+        self.max_depth = 0
+        self.sent = 0
+        self.errors = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.next_stats = time.time() + stats_interval
+
+        self.thread = threading.Thread(target=self.worker)
+        self.thread.start()
+
+    def put(self, item):
+        """Schedule a packet."""
+        if len(item) == 2:
+            item = (item[0], item[1], self.socket)
+
+        due = time.time() + self.delay
+        with self.condition:
+            # The counter keeps packets with the same due time in order
+            heapq.heappush(self.heap, (due, next(self.counter), item))
+            self.max_depth = max(self.max_depth, len(self.heap))
+
+            # Only wake up the worker if it was waiting for a packet
+            if len(self.heap) == 1:
+                self.condition.notify()
+
+    def get_due(self):
+        """Remove the packets which are due from the heap.
+
+        Wait for a packet to be scheduled if there isn't any. Return the
+        current time, the due packets and how long to wait for the next one.
+        """
+        with self.condition:
+            while not self.heap:
+                self.condition.wait()
+
+            now = time.time()
+            due = []
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap))
+
+            if due:
+                return now, due, 0
+
+            return now, due, self.heap[0][0] - now
+
+    def worker(self):
+        while True:
+            now, due, timeout = self.get_due()
+            if timeout:
+                # Condition.wait polls when given a timeout, so sleep until
+                # the next packet is due. Packets are scheduled with the same
+                # delay so a new one can't be due before.
+                time.sleep(timeout)
+                continue
+
+            for due_time, _, item in due:
+                try:
+                    data, address, sock = item
+                    sock.sendto(data, address)
+                except socket.error:
+                    self.errors += 1
+                    self.logger.log(logging.ERROR,
+                                    "Failed to send packet to %s:%d",
+                                    address[0], address[1])
+                    continue
+                except Exception:
+                    # Don't let a bad packet stop the queue
+                    self.errors += 1
+                    self.logger.log(logging.ERROR,
+                                    "Failed to send packet %r: %s",
+                                    item, traceback.format_exc())
+                    continue
+
+                lag = now - due_time
+                self.sent += 1
+                self.total_lag += lag
+                self.max_lag = max(self.max_lag, lag)
+
+            if now >= self.next_stats:
+                try:
+                    self.log_stats()
+                except Exception:
+                    self.logger.log(logging.ERROR,
+                                    "Failed to log write queue stats: %s",
+                                    traceback.format_exc())
+                    self.next_stats = time.time() + self.stats_interval
+
+    def get_stats(self):
+        """Return the queue metrics."""
+        return {
+            "depth": len(self.heap),
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "errors": self.errors,
+            "average_lag": self.total_lag / self.sent if self.sent else 0.0,
+            "max_lag": self.max_lag,
+        }
+
+    def log_stats(self):
+        """Log the metrics of the last interval and reset them."""
+        stats = self.get_stats()
+        if stats["sent"] or stats["errors"]:
+            self.logger.log(logging.INFO,
+                            "Write queue: %d pending (max %d), %d sent,"
+                            " %d errors, send lag %.1f ms (max %.1f ms)",
+                            stats["depth"], stats["max_depth"],
+                            stats["sent"], stats["errors"],
+                            stats["average_lag"] * 1000,
+                            stats["max_lag"] * 1000)
+
+        self.max_depth = len(self.heap)
+        self.sent = 0
+        self.errors = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.next_stats = time.time() + self.stats_interval
@@ -40,7 +40,7 @@ Basic idea:
     a SQL database.
 
  - qr_server and server_browser both will act as clients to
-   gs_server_database.
+   gs_server_database (see gamespy.gs_backend).
  - qr_server will send an add and/or delete to add or remove servers from the
    server list.
  - server_browser will send a request with the game name followed by optional
@@ -50,10 +50,13 @@ Basic idea:
 import logging
 import time
 import ast
+import keyword
+import threading
 
-from multiprocessing.managers import BaseManager
+from collections import OrderedDict
 from multiprocessing import freeze_support
-from other.sql import sql_commands, LIKE
+from other.sql import sql_commands
+import gamespy.gs_backend as gs_backend
 import other.utils as utils
 import dwc_config
 
@@ -68,63 +71,232 @@ class TokenType:
     TOKEN = 4
 
 
-class GameSpyServerDatabase(BaseManager):
-    pass
+class ServerFilter(object):
+    """Server browser filter compiled into a reusable predicate.
+
+    The filter is tokenized, parsed and compiled only once. Each field used
+    by the filter is replaced by a placeholder variable which gets its value
+    from the server being matched. Since validate_ast only cares about the
+    type of the literals, the validation result is cached for each
+    combination of field types (number or string).
+    """
+    namespace = dict(sql_commands, __builtins__={})
+
+    def __init__(self, backend, filters):
+        self.backend = backend
+        self.filters = filters
+        self.fields = []
+        self.valid_signatures = {}
+
+        translated, variables = backend.translate_expression(filters)
+
+        for idx in variables:
+            token = translated[idx]
+
+            if keyword.iskeyword(token):
+                # and, or, not, etc.
+                continue
+
+            # The type a numeric field is converted to only depends on the
+            # tokens on its right.
+            context = None
+            for idx2 in range(idx + 1, len(translated)):
+                _, _, token_type = backend.get_token(translated[idx2])
+
+                if token_type == TokenType.TOKEN and \
+                   translated[idx2] not in ('(', ')'):
+                    if idx2 == idx + 1:
+                        # Skip boolean operator if it's the first token on
+                        # the right
+                        continue
+
+                    # Boolean operator, leave left as integer
+                    context = TokenType.NUMBER
+                    break
+
+                elif token_type == TokenType.STRING or \
+                        token_type == TokenType.NUMBER:
+                    context = token_type
+                    break
+
+            name = "__field%d__" % len(self.fields)
+            self.fields.append((idx, name, token, context))
+            translated[idx] = name
+
+        self.translated = translated
+        self.tree = ast.parse(' '.join(translated), "<filter>", "eval")
+        self.code = compile(self.tree, "<filter>", "eval")
+
+        # Equality predicates which must all be true for the filter to
+        # match, used to look up candidates in the server indexes.
+        self.equalities = []
+        self.find_equalities(self.tree.body,
+                             {name: field
+                              for _, name, field, _ in self.fields})
+
+    def find_equalities(self, node, names):
+        """Find the "field = literal" comparisons joined by top-level and."""
+        if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+            for value in node.values:
+                self.find_equalities(value, names)
+
+        elif isinstance(node, ast.Compare) and \
+                len(node.ops) == 1 and \
+                isinstance(node.ops[0], ast.Eq) and \
+                isinstance(node.left, ast.Name) and \
+                node.left.id in names:
+            literal = node.comparators[0]
+
+            if isinstance(literal, ast.Num) and \
+               isinstance(literal.n, (int, long)):
+                value = str(literal.n)
+            elif isinstance(literal, ast.Str):
+                value = literal.s
+            else:
+                return
+
+            self.equalities.append((
+                names[node.left.id],
+                self.backend.get_index_key(value)
+            ))
+
+    def convert(self, value, context):
+        """Convert a server value the same way it would be written in the
+        filter expression."""
+        _, _, token_type = self.backend.get_token(value)
+
+        if token_type == TokenType.NUMBER and context != TokenType.STRING:
+            return int(value)
+
+        return value
+
+    def is_valid(self, signature):
+        """Run validate_ast on the filter using dummy literals of the given
+        types."""
+        if signature in self.valid_signatures:
+            return self.valid_signatures[signature]
+
+        translated = list(self.translated)
+        for (idx, _, _, _), is_str in zip(self.fields, signature):
+            translated[idx] = "''" if is_str else "0"
+
+        # Always run validate_ast over the entire AST before evaluating
+        # anything. eval() is dangerous to use on unsanitized inputs. The
+        # validate_ast function has a fairly strict whitelist so it should be
+        # safe in what it accepts as valid.
+        m = ast.parse(' '.join(translated), "<string>", "eval")
+        valid = self.backend.validate_ast(m.body, False)
+
+        if not valid:
+            logger.log(logging.WARNING,
+                       "Invalid filter(s): %s",
+                       self.filters)
+
+        self.valid_signatures[signature] = valid
+        return valid
+
+    def match(self, server):
+        values = {}
+        signature = []
+
+        for _, name, field, context in self.fields:
+            if field not in server:
+                # Unknown variables aren't valid
+                return False
+
+            try:
+                value = self.convert(server[field], context)
+            except ValueError:
+                return False
+
+            values[name] = value
+            signature.append(isinstance(value, basestring))
+
+        if not self.is_valid(tuple(signature)):
+            return False
+
+        return eval(self.code, self.namespace, values)
 
 
 class GameSpyBackendServer(object):
+    # Number of compiled filters to keep around
+    filter_cache_size = 256
+
+    # Fields commonly used in "field = value" filters which are indexed for
+    # each game.
+    indexed_fields = (
+        "dwc_mver", "dwc_mtype", "maxplayers",
+        "dwc_hoststate", "dwc_suspend", "rk"
+    )
+
     def __init__(self):
+        # Servers of each game are stored by session id, in the order they
+        # were last updated.
         self.server_list = {}
-        self.natneg_list = {}
-
-        GameSpyServerDatabase.register(
-            "get_server_list",
-            callable=lambda: self.server_list
-        )
-        GameSpyServerDatabase.register(
-            "find_servers",
-            callable=self.find_servers
-        )
-        GameSpyServerDatabase.register(
-            "find_server_by_address",
-            callable=self.find_server_by_address
-        )
-        GameSpyServerDatabase.register(
-            "find_server_by_local_address",
-            callable=self.find_server_by_local_address
-        )
-        GameSpyServerDatabase.register(
-            "update_server_list",
-            callable=self.update_server_list
-        )
-        GameSpyServerDatabase.register(
-            "delete_server",
-            callable=self.delete_server
-        )
-        GameSpyServerDatabase.register(
-            "add_natneg_server",
-            callable=self.add_natneg_server
+        self.server_index = {}
+
+        # Bumped every time the servers of a game change so the server
+        # browser knows when its cached server lists are outdated.
+        self.generations = {}
+
+        # Servers by address, used to resolve the servers involved in
+        # server browser messages and NAT negotiations.
+        self.address_index = {}
+        self.public_address_index = {}
+        self.local_address_index = {}
+
+        # Servers involved in NAT negotiations, by cookie. Entries are
+        # (deadline, servers) in the order they were added so the expired
+        # ones are at the front. At most natneg_list_size servers are kept,
+        # the oldest cookies are evicted first.
+        self.natneg_list = OrderedDict()
+        self.natneg_list_count = 0
+        self.natneg_list_lock = threading.Lock()
+        self.natneg_timeout = dwc_config.get_int(
+            'GameSpyManager', 'NatnegTimeout', 120
         )
-        GameSpyServerDatabase.register(
-            "get_natneg_server",
-            callable=self.get_natneg_server
+        self.natneg_list_size = dwc_config.get_int(
+            'GameSpyManager', 'NatnegListSize', 10000
         )
-        GameSpyServerDatabase.register(
-            "delete_natneg_server",
-            callable=self.delete_natneg_server
+        self.natneg_stats = dict.fromkeys(
+            ["added", "deleted", "expired", "evicted"], 0
         )
 
+        # Negotiation stats of each game, sent by the NAT negotiation server
+        self.natneg_report = {}
+        self.filter_cache = OrderedDict()
+        self.filter_cache_lock = threading.Lock()
+
+        # BackendServer is a ThreadingTCPServer, each connection is handled
+        # in its own thread
+        self.lock = threading.RLock()
+
+        # Methods available to the other servers
+        self.methods = {
+            "get_server_list": self.get_server_list,
+            "get_generation": self.get_generation,
+            "find_servers": self.find_servers,
+            "find_server_by_address": self.find_server_by_address,
+            "find_server_by_local_address":
+                self.find_server_by_local_address,
+            "update_server_list": self.update_server_list,
+            "delete_server": self.delete_server,
+            "add_natneg_server": self.add_natneg_server,
+            "get_natneg_server": self.get_natneg_server,
+            "delete_natneg_server": self.delete_natneg_server,
+            "get_natneg_stats": self.get_natneg_stats,
+            "set_natneg_report": self.set_natneg_report,
+            "get_natneg_report": self.get_natneg_report,
+        }
+
     def start(self):
         address = dwc_config.get_ip_port('GameSpyManager')
-        password = ""
 
         logger.log(logging.INFO,
                    "Started server on %s:%d...",
                    address[0], address[1])
 
-        manager = GameSpyServerDatabase(address=address,
-                                        authkey=password)
-        server = manager.get_server()
+        server = gs_backend.BackendServer(address, self.methods, logger)
         server.serve_forever()
 
     def get_token(self, filters):
@@ -345,7 +517,136 @@ class GameSpyBackendServer(object):
 
         return valid_node
 
+    def compile_filter(self, filters):
+        """Return the compiled filter, or None if the filter is invalid.
+
+        Games keep sending the same few filters so the compiled filters are
+        stored in a LRU cache using the raw filter as key.
+        """
+        with self.filter_cache_lock:
+            if filters in self.filter_cache:
+                server_filter = self.filter_cache.pop(filters)
+                self.filter_cache[filters] = server_filter
+                return server_filter
+
+        try:
+            server_filter = ServerFilter(self, filters)
+        except (SyntaxError, TypeError, ValueError):
+            logger.log(logging.WARNING,
+                       "Invalid filter(s): %s",
+                       filters)
+            server_filter = None
+
+        with self.filter_cache_lock:
+            self.filter_cache[filters] = server_filter
+            while len(self.filter_cache) > self.filter_cache_size:
+                self.filter_cache.popitem(last=False)
+
+        return server_filter
+
+    def get_index_key(self, value):
+        """Return the key used to index a server value.
+
+        Numbers are normalized since the filters compare them as integers.
+        """
+        if not isinstance(value, basestring):
+            return value
+
+        _, _, token_type = self.get_token(value)
+        if token_type == TokenType.NUMBER:
+            try:
+                return str(int(value))
+            except ValueError:
+                pass
+
+        return value
+
+    def get_address_keys(self, server):
+        """Return the keys used in each address index."""
+        if 'publicip' not in server:
+            return []
+
+        publicip = server['publicip']
+        keys = [(self.address_index, publicip)]
+
+        if 'publicport' in server:
+            keys.append((self.public_address_index,
+                         (publicip, server['publicport'])))
+
+        if 'localport' in server:
+            keys.append((self.local_address_index,
+                         (publicip, server['localport'])))
+
+        return keys
+
+    def index_server(self, gameid, server):
+        index = self.server_index.setdefault(gameid, {})
+        session = server['__session__']
+
+        for field in self.indexed_fields:
+            if field in server:
+                index.setdefault(field, {}) \
+                     .setdefault(self.get_index_key(server[field]),
+                                 OrderedDict())[session] = server
+
+        for address_index, key in self.get_address_keys(server):
+            address_index.setdefault(key, OrderedDict())[gameid, session] = \
+                server
+
+    def unindex_server(self, gameid, server):
+        index = self.server_index.get(gameid, {})
+        session = server['__session__']
+
+        for field in self.indexed_fields:
+            if field not in server or field not in index:
+                continue
+
+            key = self.get_index_key(server[field])
+            bucket = index[field].get(key)
+            if bucket is not None:
+                bucket.pop(session, None)
+
+                if not bucket:
+                    del index[field][key]
+
+        for address_index, key in self.get_address_keys(server):
+            bucket = address_index.get(key)
+            if bucket is not None:
+                bucket.pop((gameid, session), None)
+
+                if not bucket:
+                    del address_index[key]
+
+    def get_candidates(self, gameid, server_filter):
+        """Return the servers that might match the filter.
+
+        The smallest index bucket among the filter's equality predicates is
+        used, the filter still has to be evaluated on each candidate.
+        """
+        index = self.server_index.get(gameid, {})
+        best = None
+
+        for field, key in server_filter.equalities:
+            if field not in index:
+                continue
+
+            bucket = index[field].get(key)
+            if bucket is None:
+                return []
+
+            if best is None or len(bucket) < len(best):
+                best = bucket
+
+        if best is None:
+            return self.server_list[gameid].itervalues()
+
+        return best.itervalues()
+
     def find_servers(self, gameid, filters, fields, max_count):
+        with self.lock:
+            return self._find_servers(gameid, filters, fields, max_count)
+
+    def _find_servers(self, gameid, filters, fields, max_count):
         matched_servers = []
 
         if gameid not in self.server_list:
@@ -353,96 +654,18 @@ class GameSpyBackendServer(object):
 
         start = time.time()
 
-        for server in self.server_list[gameid]:
-            stop_search = False
-
-            if filters:
-                translated, variables = self.translate_expression(filters)
-
-                for idx in variables:
-                    token = translated[idx]
-
-                    if token in server:
-                        token = server[token]
-                        _, _, token_type = self.get_token(token)
-
-                        if token_type == TokenType.FIELD:
-                            # At this point, any field should be a string.
-                            # This does not support stuff like:
-                            # dwc_test = 'test', dwc_test2 = dwc_test,
-                            # dwc_test3 = dwc_test2
-                            token = '"' + token + '"'
-
-                        elif token_type == TokenType.NUMBER:
-                            for idx2 in range(idx + 1, len(translated)):
-                                _, _, token_type = \
-                                    self.get_token(translated[idx2])
-
-                                if token_type == TokenType.TOKEN and \
-                                   translated[idx2] not in ('(', ')'):
-                                    if idx2 == idx + 1:
-                                        # Skip boolean operator if it's the
-                                        # first token on the right
-                                        continue
-
-                                    # Boolean operator, leave left as integer
-                                    token = str(int(token))
-                                    break
-
-                                elif token_type == TokenType.STRING or \
-                                        token_type == TokenType.NUMBER:
-                                    if token_type == TokenType.STRING:
-                                        # Found string on far right, turn left
-                                        # into string as well
-                                        token = "'" + token + "'"
-                                    elif token_type == TokenType.NUMBER:
-                                        token = str(int(token))
-                                    break
-
-                        translated[idx] = token
-
-                q = ' '.join(translated)
-
-                # Always run validate_ast over the entire AST before
-                # evaluating anything. eval() is dangerous to use on
-                # unsanitized inputs. The validate_ast function has a fairly
-                # strict whitelist so it should be safe in what it accepts as
-                # valid.
-                m = ast.parse(q, "<string>", "exec")
-                valid_filter = True
-                for node in m.body:
-                    valid_filter = self.validate_ast(node, False)
-
-                if not valid_filter:
-                    # Return only anything matched up until this point.
-                    logger.log(logging.WARNING,
-                               "Invalid filter(s): %s",
-                               filters)
-                    # stop_search = True
-                    continue
-                else:
-                    # Use Python to evaluate the query. This method may take a
-                    # little time but it shouldn't be all that big of a
-                    # difference, I think. It takes about 0.0004 seconds per
-                    # server to determine whether or not it's a match on my
-                    # computer. Usually there's a low max_servers set when the
-                    # game searches for servers, so assuming something like
-                    # the game is asking for 6 servers, it would take about
-                    # 0.0024 seconds total. These times will obviously be
-                    # different per computer. It's not ideal, but it shouldn't
-                    # be a huge bottleneck. A possible way to speed it up is
-                    # to make validate_ast also evaluate the expressions at
-                    # the same time as it validates it.
-                    result = eval(q)
-            else:
-                # There are no filters, so just return the server.
-                result = True
-                valid_filter = True
+        server_filter = None
+        candidates = self.server_list[gameid].itervalues()
+        if filters:
+            server_filter = self.compile_filter(filters)
 
-            if stop_search:
-                break
+            if server_filter is None:
+                return []
 
-            if valid_filter and result:
+            candidates = self.get_candidates(gameid, server_filter)
+
+        for server in candidates:
+            if server_filter is None or server_filter.match(server):
                 matched_servers.append(server)
 
                 if max_count and len(matched_servers) >= max_count:
@@ -486,56 +709,73 @@ class GameSpyBackendServer(object):
 
         return servers
 
+    def get_server_list(self):
+        """Return the servers of each game."""
+        with self.lock:
+            return {gameid: servers.values()
+                    for gameid, servers in self.server_list.items()}
+
+    def get_generation(self, gameid):
+        """Return the generation of the server list of a game."""
+        return self.generations.get(gameid, 0)
+
     def update_server_list(self, gameid, session, value, console):
         """Make sure the user isn't hosting multiple servers or there isn't
         some left over server information that never got handled properly
         (game crashed, etc)."""
-        self.delete_server(gameid, session)
-
-        # If the game doesn't exist already, create a new list.
-        if gameid not in self.server_list:
-            self.server_list[gameid] = []
+        with self.lock:
+            self.delete_server(gameid, session)
 
-        # Add new server
-        value['__session__'] = session
-        value['__console__'] = console
-
-        logger.log(logging.DEBUG,
-                   "Added %s to the server list for %s",
-                   value, gameid)
-        self.server_list[gameid].append(value)
-        logger.log(logging.DEBUG,
-                   "%s servers: %d",
-                   gameid, len(self.server_list[gameid]))
+            # If the game doesn't exist already, create a new list.
+            if gameid not in self.server_list:
+                self.server_list[gameid] = OrderedDict()
+
+            # Add new server
+            value['__session__'] = session
+            value['__console__'] = console
+
+            logger.log(logging.DEBUG,
+                       "Added %s to the server list for %s",
+                       value, gameid)
+            self.server_list[gameid][session] = value
+            self.index_server(gameid, value)
+            self.generations[gameid] = self.generations.get(gameid, 0) + 1
+            logger.log(logging.DEBUG,
+                       "%s servers: %d",
+                       gameid, len(self.server_list[gameid]))
 
         return value
 
     def delete_server(self, gameid, session):
-        if gameid not in self.server_list:
-            # Nothing to do if no servers for that game even exist.
-            return
-
-        # Remove all servers hosted by the given session id.
-        count = len(self.server_list[gameid])
-        self.server_list[gameid] = [x for x in self.server_list[gameid]
-                                    if x['__session__'] != session]
-        count -= len(self.server_list[gameid])
+        with self.lock:
+            if gameid not in self.server_list:
+                # Nothing to do if no servers for that game even exist.
+                return
+
+            # Remove the server hosted by the given session id.
+            server = self.server_list[gameid].pop(session, None)
+            if server is None:
+                return
+
+            self.unindex_server(gameid, server)
+            self.generations[gameid] = self.generations.get(gameid, 0) + 1
+
         logger.log(logging.DEBUG,
-                   "Deleted %d %s servers where session = %d",
-                   count, gameid, session)
+                   "Deleted %s server where session = %d",
+                   gameid, session)
 
     def find_server_by_address(self, ip, port, gameid=None):
-        if gameid is None:
-            # Search all servers
-            for gameid in self.server_list:
-                for server in self.server_list[gameid]:
-                    if server['publicip'] == ip and \
-                       (not port or server['publicport'] == str(port)):
-                        return server
+        if port:
+            address_index = self.public_address_index
+            key = (ip, str(port))
         else:
-            for server in self.server_list[gameid]:
-                if server['publicip'] == ip and \
-                   (not port or server['publicport'] == str(port)):
+            address_index = self.address_index
+            key = ip
+
+        with self.lock:
+            bucket = address_index.get(key, {})
+            for (server_gameid, _), server in bucket.iteritems():
+                if gameid is None or server_gameid == gameid:
                     return server
 
         return None
@@ -543,27 +783,22 @@ class GameSpyBackendServer(object):
     def find_server_by_local_address(self, publicip, localaddr, gameid=None):
         localip = localaddr[0]
         localport = localaddr[1]
-        localip_int_le = localaddr[2]
-        localip_int_be = localaddr[3]
-
-        def find_server(gameid):
-            if gameid not in self.server_list:
-                return None
 
+        with self.lock:
             best_match = None
 
-            for server in self.server_list[gameid]:
-                logger.log(logging.DEBUG,
-                           "publicip: %s == %s ? %d localport: %s == %s ? %d",
-                           server['publicip'], publicip,
-                           server['publicip'] == publicip,
-                           server['localport'],
-                           str(localport),
-                           server['localport'] == str(localport))
-                if server['publicip'] == publicip:
-                    if server['localport'] == str(localport):
-                        best_match = server
-                        break
+            bucket = self.local_address_index.get((publicip, str(localport)),
+                                                  {})
+            for (server_gameid, _), server in bucket.iteritems():
+                if gameid is None or server_gameid == gameid:
+                    best_match = server
+                    break
+
+            if best_match is None:
+                bucket = self.address_index.get(publicip, {})
+                for (server_gameid, _), server in bucket.iteritems():
+                    if gameid is not None and server_gameid != gameid:
+                        continue
 
                     for x in range(0, 10):
                         s = 'localip%d' % x
@@ -580,41 +815,77 @@ class GameSpyBackendServer(object):
                         # least make an attempt to establish the connection.
                         best_match = server
 
-            if best_match is None:
-                logger.log(logging.DEBUG,
-                           "Couldn't find a match for %s",
-                           publicip)
-
-            return best_match
+        if best_match is None:
+            logger.log(logging.DEBUG,
+                       "Couldn't find a match for %s",
+                       publicip)
+
+        return best_match
+
+    def remove_natneg_cookie(self, cookie, reason):
+        """Remove a cookie from natneg_list, natneg_list_lock must be held."""
+        _, servers = self.natneg_list.pop(cookie)
+        self.natneg_list_count -= len(servers)
+        self.natneg_stats[reason] += 1
+
+    def expire_natneg_list(self):
+        """Remove the expired and the excess cookies, natneg_list_lock must
+        be held."""
+        now = time.time()
+        while self.natneg_list:
+            cookie, (deadline, _) = next(self.natneg_list.iteritems())
+            if deadline > now:
+                break
+            self.remove_natneg_cookie(cookie, "expired")
 
-        if gameid is None:
-            # Search all servers
-            for gameid in self.server_list:
-                return find_server(gameid)
-        else:
-            return find_server(gameid)
-
-        return None
+        while self.natneg_list_count > self.natneg_list_size:
+            cookie = next(iter(self.natneg_list))
+            self.remove_natneg_cookie(cookie, "evicted")
+            logger.log(logging.DEBUG, "Evicted natneg server %d", cookie)
 
     def add_natneg_server(self, cookie, server):
-        if cookie not in self.natneg_list:
-            self.natneg_list[cookie] = []
+        with self.natneg_list_lock:
+            if cookie not in self.natneg_list:
+                self.natneg_list[cookie] = \
+                    (time.time() + self.natneg_timeout, [])
+                self.natneg_stats["added"] += 1
+
+            logger.log(logging.DEBUG, "Added natneg server %d", cookie)
+            self.natneg_list[cookie][1].append(server)
+            self.natneg_list_count += 1
 
-        logger.log(logging.DEBUG, "Added natneg server %d", cookie)
-        self.natneg_list[cookie].append(server)
+            self.expire_natneg_list()
 
     def get_natneg_server(self, cookie):
-        if cookie in self.natneg_list:
-            return self.natneg_list[cookie]
+        with self.natneg_list_lock:
+            self.expire_natneg_list()
+
+            if cookie in self.natneg_list:
+                return self.natneg_list[cookie][1]
 
         return None
 
     def delete_natneg_server(self, cookie):
-        """TODO: Find a good time to prune the natneg server listing."""
-        if cookie in self.natneg_list:
-            del self.natneg_list[cookie]
+        with self.natneg_list_lock:
+            if cookie in self.natneg_list:
+                self.remove_natneg_cookie(cookie, "deleted")
         logger.log(logging.DEBUG, "Deleted natneg server %d", cookie)
 
+    def get_natneg_stats(self):
+        """Return the size of natneg_list and how many cookies were added
+        and removed since the server started."""
+        with self.natneg_list_lock:
+            stats = dict(self.natneg_stats)
+            stats["cookies"] = len(self.natneg_list)
+            stats["servers"] = self.natneg_list_count
+            return stats
+
+    def set_natneg_report(self, report):
+        self.natneg_report = report
+
+    def get_natneg_report(self):
+        return self.natneg_report
+
 
 if __name__ == '__main__':
     freeze_support()
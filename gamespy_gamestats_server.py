@@ -401,19 +401,7 @@ class Gamestats(LineReceiver):
         return
 
     def crypt(self, data):
-        key = bytearray(b"GameSpy3D")
-        key_len = len(key)
-        output = bytearray(data.encode("ascii"))
-
-        if "\\final\\" in output:
-            end = output.index("\\final\\")
-        else:
-            end = len(output)
-
-        for i in range(end):
-            output[i] ^= key[i % key_len]
-
-        return output
+        return gs_utils.gamestats_crypt(data)
 
 
 if __name__ == "__main__":
@@ -25,39 +25,35 @@
 """
 
 import logging
-import SocketServer
-import threading
 import time
-import Queue
+import traceback
+from collections import OrderedDict
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.internet.error import ReactorAlreadyRunning
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.task import LoopingCall
+
 import gamespy.gs_utility as gs_utils
 import other.utils as utils
-import traceback
 
-from multiprocessing.managers import BaseManager
+import gamespy.gs_backend as gs_backend
+import gamespy.gs_natneg_stats as gs_natneg_stats
+import gamespy.gs_rate_limit as gs_rate_limit
+import gamespy.gs_write_queue as gs_write_queue
 import dwc_config
 
 logger = dwc_config.get_logger('GameSpyNatNegServer')
 
 
-class GameSpyServerDatabase(BaseManager):
-    pass
-
-GameSpyServerDatabase.register("get_server_list")
-GameSpyServerDatabase.register("modify_server_list")
-GameSpyServerDatabase.register("find_servers")
-GameSpyServerDatabase.register("find_server_by_address")
-GameSpyServerDatabase.register("find_server_by_local_address")
-GameSpyServerDatabase.register("add_natneg_server")
-GameSpyServerDatabase.register("get_natneg_server")
-GameSpyServerDatabase.register("delete_natneg_server")
-
-
 def handle_natneg(nn, recv_data, addr, socket):
     """Command: Unknown."""
     logger.log(logging.DEBUG,
                "Received unknown command %02x from %s:%d...",
                ord(recv_data[7]), *addr)
-    logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(recv_data))
+    logger.log(logging.DEBUG, "%s", utils.HexDump(recv_data))
 
 
 def handle_natneg_init(nn, recv_data, addr, socket):
@@ -96,6 +92,7 @@ def handle_natneg_init(nn, recv_data, addr, socket):
 
     # Try to connect to the server
     gameid = utils.get_string(recv_data, 0x15)
+    port_type = ord(recv_data[12])
     client_id = "%02x" % ord(recv_data[13])
     localaddr = utils.get_local_addr(recv_data, 15)
 
@@ -106,7 +103,6 @@ def handle_natneg_init(nn, recv_data, addr, socket):
                         'connected': False,
                         'addr': '',
                         'localaddr': None,
-                        'serveraddr': None,
                         'gameid': None
                     })
 
@@ -116,71 +112,118 @@ def handle_natneg_init(nn, recv_data, addr, socket):
     client_id_session['addr'] = addr
     client_id_session['localaddr'] = localaddr
 
-    for client in nn.session_list[session_id]:
-        # Another pointer
-        client_session = nn.session_list[session_id][client]
-        if client_session['connected'] or client == client_id:
+    nn.refresh_deadline(nn.session_deadlines, session_id)
+    nn.timelines.event(session_id, "init", ord(recv_data[13]),
+                       nn.get_gameid(gameid))
+
+    # Clients send an INIT for each port type, and send them again until
+    # they receive NN_CONNECT. The clients of a port type are paired once,
+    # the NN_CONNECT packets are kept for the retransmitted INITs.
+    pair = nn.natneg_pairs \
+        .setdefault(session_id, {}) \
+        .setdefault(port_type, {'clients': {}, 'packets': None})
+
+    if pair['packets'] is not None:
+        output = pair['packets'].get(client_id)
+        if output is not None:
+            nn.write_queue.put((output, addr, socket))
+            logger.log(logging.DEBUG,
+                       "Resent connection request to %s:%d...", *addr)
+        return
+
+    pair['clients'][client_id] = {
+        'addr': addr,
+        'localaddr': localaddr,
+        'gameid': gameid,
+        'serveraddr': None
+    }
+
+    for client in pair['clients']:
+        if nn.session_list[session_id][client]['connected'] or \
+           client == client_id:
             continue
 
-        # --- Send to requesting client
-        # Get server info
-        serveraddr = nn.get_server_addr(gameid, session_id, client)
-        client_session['serveraddr'] = serveraddr
-        logger.log(logging.DEBUG,
-                   "Found server from local ip/port: %s from %d",
-                   serveraddr, session_id)
-
-        # Get public port
-        if client_session['serveraddr'] is not None:
-            publicport = int(client_session['serveraddr']['publicport'])
-        else:
-            publicport = \
-                client_session['localaddr'][1] or \
-                client_session['addr'][1]
-
-        output = bytearray(recv_data[0:12])
-        output += utils.get_bytes_from_ip_str(client_session['addr'][0])
-        output += utils.get_bytes_from_short(publicport, True)
-
-        # Unknown, always seems to be \x42\x00
-        output += bytearray([0x42, 0x00])
-        output[7] = 0x05  # NN_CONNECT
-        nn.write_queue.put((output, client_id_session['addr'], socket))
-
-        logger.log(logging.DEBUG,
-                   "Sent connection request to %s:%d...",
-                   *client_id_session['addr'])
-        logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(output))
-
-        # --- Send to other client
-        # Get server info
-        serveraddr = nn.get_server_addr(gameid, session_id, client_id)
-        client_id_session['serveraddr'] = serveraddr
-        logger.log(logging.DEBUG,
-                   "Found server 2 from local ip/port: %s from %d",
-                   serveraddr, session_id)
-
-        # Get public port
-        if client_id_session['serveraddr'] is not None:
-            publicport = int(client_id_session['serveraddr']['publicport'])
-        else:
-            publicport = \
-                client_id_session['localaddr'][1] or \
-                client_id_session['addr'][1]
-
-        output = bytearray(recv_data[0:12])
-        output += utils.get_bytes_from_ip_str(client_id_session['addr'][0])
-        output += utils.get_bytes_from_short(publicport, True)
-
-        # Unknown, always seems to be \x42\x00
-        output += bytearray([0x42, 0x00])
-        output[7] = 0x05  # NN_CONNECT
-        nn.write_queue.put((output, client_session['addr'], socket))
-
-        logger.log(logging.DEBUG,
-                   "Sent connection request to %s:%d...",
-                   *client_session['addr'])
-        logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(output))
+        # Retransmitted INITs don't start another pairing while the
+        # servers are looked up
+        pair['packets'] = {}
+
+        # Get server info of both clients without blocking the reactor
+        d = nn.get_server_addrs(gameid, session_id,
+                                pair['clients'][client],
+                                pair['clients'][client_id])
+        d.addCallback(send_natneg_connect, nn, recv_data, session_id,
+                      pair, client, client_id, socket)
+        d.addErrback(natneg_connect_failed, nn, session_id, pair)
+        break
+
+
+def natneg_connect_failed(failure, nn, session_id, pair):
+    """Let the next INIT retry the pairing if the servers lookup failed."""
+    logger.log(logging.ERROR, "Failed to get server info: %s",
+               failure.getTraceback())
+
+    pair['packets'] = None
+    nn.server_cache.pop(session_id, None)
+
+
+def get_natneg_connect(recv_data, client_session):
+    """Return the NN_CONNECT packet telling to connect to client_session."""
+    # Get public port
+    if client_session['serveraddr'] is not None:
+        publicport = int(client_session['serveraddr']['publicport'])
+    else:
+        publicport = \
+            client_session['localaddr'][1] or \
+            client_session['addr'][1]
+
+    output = bytearray(recv_data[0:12])
+    output += utils.get_bytes_from_ip_str(client_session['addr'][0])
+    output += utils.get_bytes_from_short(publicport, True)
+
+    # Unknown, always seems to be \x42\x00
+    output += bytearray([0x42, 0x00])
+    output[7] = 0x05  # NN_CONNECT
+    return output
+
+
+def send_natneg_connect(serveraddrs, nn, recv_data, session_id, pair,
+                        client, client_id, socket):
+    """Send NN_CONNECT to both clients of a pair once their servers are
+    known."""
+    nn.timelines.event(session_id, "connect")
+
+    client_session = pair['clients'][client]
+    client_id_session = pair['clients'][client_id]
+
+    # --- Send to requesting client
+    client_session['serveraddr'] = serveraddrs[0]
+    logger.log(logging.DEBUG,
+               "Found server from local ip/port: %s from %d",
+               serveraddrs[0], session_id)
+
+    output = get_natneg_connect(recv_data, client_session)
+    pair['packets'][client_id] = output
+    nn.write_queue.put((output, client_id_session['addr'], socket))
+
+    logger.log(logging.DEBUG,
+               "Sent connection request to %s:%d...",
+               *client_id_session['addr'])
+    logger.log(logging.DEBUG, "%s", utils.HexDump(output))
+
+    # --- Send to other client
+    client_id_session['serveraddr'] = serveraddrs[1]
+    logger.log(logging.DEBUG,
+               "Found server 2 from local ip/port: %s from %d",
+               serveraddrs[1], session_id)
+
+    output = get_natneg_connect(recv_data, client_id_session)
+    pair['packets'][client] = output
+    nn.write_queue.put((output, client_session['addr'], socket))
+
+    logger.log(logging.DEBUG,
+               "Sent connection request to %s:%d...",
+               *client_session['addr'])
+    logger.log(logging.DEBUG, "%s", utils.HexDump(output))
 
 
 def handle_natneg_initack(nn, recv_data, addr, socket):
@@ -207,7 +250,7 @@ def handle_natneg_initack(nn, recv_data, addr, socket):
     logger.log(logging.WARNING,
                "Received server record type command NN_INITACK (0x01)"
                " from %s:%d...", *addr)
-    logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(recv_data))
+    logger.log(logging.DEBUG, "%s", utils.HexDump(recv_data))
 
 
 def handle_natneg_erttest(nn, recv_data, addr, socket):
@@ -239,7 +282,7 @@ def handle_natneg_erttest(nn, recv_data, addr, socket):
     logger.log(logging.WARNING,
                "Received server record type command NN_ERTTEST (0x02)"
                " from %s:%d...", *addr)
-    logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(recv_data))
+    logger.log(logging.DEBUG, "%s", utils.HexDump(recv_data))
 
 
 def handle_natneg_ertack(nn, recv_data, addr, socket):
@@ -286,7 +329,7 @@ def handle_natneg_stateupdate(nn, recv_data, addr, socket):
     logger.log(logging.WARNING,
                "Received unimplemented command NN_STATEUPDATE (0x04)"
                " from %s:%d...", *addr)
-    logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(output))
+    logger.log(logging.DEBUG, "%s", utils.HexDump(recv_data))
 
 
 def handle_natneg_connect(nn, recv_data, addr, socket):
@@ -311,7 +354,7 @@ def handle_natneg_connect(nn, recv_data, addr, socket):
     logger.log(logging.WARNING,
                "Received server record type command NN_CONNECT (0x05)"
                " from %s:%d...", *addr)
-    logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(recv_data))
+    logger.log(logging.DEBUG, "%s", utils.HexDump(recv_data))
 
 
 def handle_natneg_connect_ack(nn, recv_data, addr, socket):
@@ -344,6 +387,7 @@ def handle_natneg_connect_ack(nn, recv_data, addr, socket):
     if session_id in nn.session_list and \
        client_id in nn.session_list[session_id]:
         nn.session_list[session_id][client_id]['connected'] = True
+        nn.timelines.event(session_id, "connect_ack", ord(recv_data[13]))
 
 
 def handle_natneg_connect_ping(nn, recv_data, addr, socket):
@@ -369,7 +413,7 @@ def handle_natneg_connect_ping(nn, recv_data, addr, socket):
     logger.log(logging.WARNING,
                "Received unimplemented command NN_CONNECT_PING (0x07)"
                " from %s:%d...", *addr)
-    logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(recv_data))
+    logger.log(logging.DEBUG, "%s", utils.HexDump(recv_data))
 
 
 def handle_natneg_backup_test(nn, recv_data, addr, socket):
@@ -384,7 +428,7 @@ def handle_natneg_backup_test(nn, recv_data, addr, socket):
     Untested
     """
     logger.log(logging.DEBUG, "Received backup command from %s:%d...", *addr)
-    logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(recv_data))
+    logger.log(logging.DEBUG, "%s", utils.HexDump(recv_data))
 
     # Backup response
     output = bytearray(recv_data)
@@ -407,7 +451,7 @@ def handle_natneg_backup_ack(nn, recv_data, addr, socket):
     logger.log(logging.WARNING,
                "Received server record type command NN_BACKUP_ACK (0x09)"
                " from %s:%d...", *addr)
-    logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(output))
+    logger.log(logging.DEBUG, "%s", utils.HexDump(recv_data))
 
 
 def handle_natneg_address_check(nn, recv_data, addr, socket):
@@ -440,7 +484,7 @@ def handle_natneg_address_check(nn, recv_data, addr, socket):
     logger.log(logging.DEBUG,
                "Received address check command from %s:%d...",
                *addr)
-    logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(recv_data))
+    logger.log(logging.DEBUG, "%s", utils.HexDump(recv_data))
 
     output = bytearray(recv_data[0:15])
     output += utils.get_bytes_from_ip_str(addr[0])
@@ -451,7 +495,7 @@ def handle_natneg_address_check(nn, recv_data, addr, socket):
     nn.write_queue.put((output, addr, socket))
 
     logger.log(logging.DEBUG, "Sent address check response to %s:%d...", *addr)
-    logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(output))
+    logger.log(logging.DEBUG, "%s", utils.HexDump(output))
 
 
 def handle_natneg_address_reply(nn, recv_data, addr, socket):
@@ -478,7 +522,7 @@ def handle_natneg_address_reply(nn, recv_data, addr, socket):
     logger.log(logging.WARNING,
                "Received server record type command NN_ADDRESS_REPLY (0x0B)"
                " from %s:%d...", *addr)
-    logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(output))
+    logger.log(logging.DEBUG, "%s", utils.HexDump(recv_data))
 
 
 def handle_natneg_natify_request(nn, recv_data, addr, socket):
@@ -515,7 +559,7 @@ def handle_natneg_natify_request(nn, recv_data, addr, socket):
     nn.write_queue.put((output, addr, socket))
 
     logger.log(logging.DEBUG, "Sent natify response to %s:%d...", *addr)
-    logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(output))
+    logger.log(logging.DEBUG, "%s", utils.HexDump(output))
 
 
 def handle_natneg_report(nn, recv_data, addr, socket):
@@ -555,7 +599,11 @@ def handle_natneg_report(nn, recv_data, addr, socket):
     GAME_NAME 00      - Game name (GAME_NAME is 49 bytes length)
     """
     logger.log(logging.DEBUG, "Received report command from %s:%d...", *addr)
-    logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(recv_data))
+    logger.log(logging.DEBUG, "%s", utils.HexDump(recv_data))
+
+    nn.timelines.report(utils.get_int(recv_data, 8), ord(recv_data[13]),
+                        recv_data[14] == '\x01',
+                        nn.get_gameid(utils.get_string(recv_data, 23)))
 
     # Report response
     output = bytearray(recv_data[:21])
@@ -594,7 +642,7 @@ def handle_natneg_report_ack(nn, recv_data, addr, socket):
     logger.log(logging.WARNING,
                "Received server record type command NN_REPORT_ACK (0x0E)"
                " from %s:%d...", *addr)
-    logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(recv_data))
+    logger.log(logging.DEBUG, "%s", utils.HexDump(recv_data))
 
 
 def handle_natneg_preinit(nn, recv_data, addr, socket):
@@ -621,9 +669,11 @@ def handle_natneg_preinit(nn, recv_data, addr, socket):
     38 b2 b3 5e       - Other client's session id
     """
     logger.log(logging.DEBUG, "Received pre-init command from %s:%d...", *addr)
-    logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(recv_data))
+    logger.log(logging.DEBUG, "%s", utils.HexDump(recv_data))
 
     session = utils.get_int(recv_data[-4:], 0)
+    nn.timelines.event(utils.get_int(recv_data, 8), "preinit",
+                       ord(recv_data[12]))
 
     # Report response
     output = bytearray(recv_data[:-4]) + bytearray([0, 0, 0, 0])
@@ -646,6 +696,7 @@ def handle_natneg_preinit(nn, recv_data, addr, socket):
     else:
         output[13] = 0
         nn.natneg_preinit_session[session] = addr
+        nn.refresh_deadline(nn.preinit_session_deadlines, session)
 
     nn.write_queue.put((output, addr, socket))
 
@@ -678,11 +729,15 @@ def handle_natneg_preinit_ack(nn, recv_data, addr, socket):
     logger.log(logging.WARNING,
                "Received server record type command NN_PREINIT_ACK (0x10)"
                " from %s:%d...", *addr)
-    logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(recv_data))
+    logger.log(logging.DEBUG, "%s", utils.HexDump(recv_data))
 
 
-class GameSpyNatNegUDPServerHandler(SocketServer.BaseRequestHandler):
-    """GameSpy NAT Negotiation handler."""
+class GameSpyNatNegProtocol(DatagramProtocol):
+    """GameSpy NAT Negotiation server.
+
+    Packets are handled by the reactor, the backend is queried from its
+    thread pool so the packets of other clients don't wait for it.
+    """
 
     nn_magics = bytearray([0xfd, 0xfc, 0x1e, 0x66, 0x6a, 0xb2])
     nn_commands = {
@@ -705,13 +760,65 @@ class GameSpyNatNegUDPServerHandler(SocketServer.BaseRequestHandler):
         '\x10': handle_natneg_preinit_ack
     }
 
-    def handle(self):
+    # Interval between checks of the expired sessions, in seconds
+    expire_interval = 10
+    # Interval between reports of the negotiation stats, in seconds
+    report_interval = 60
+
+    def __init__(self):
+        self.session_list = {}
+        self.natneg_preinit_session = {}
+        self.secret_key_list = gs_utils.generate_secret_keys("gslist.cfg")
+        self.rate_limiter = gs_rate_limit.create_rate_limiter(
+            'GameSpyNatNegServer', logger
+        )
+
+        # Sessions are removed when they haven't received anything for a
+        # while. The deadlines are ordered from the oldest to the newest so
+        # only the expired ones are looked at.
+        self.session_timeout = dwc_config.get_int(
+            'GameSpyNatNegServer', 'SessionTimeout', 60
+        )
+        self.session_deadlines = OrderedDict()
+        self.preinit_session_deadlines = OrderedDict()
+
+        # Negotiations are traced to report how long connecting takes, the
+        # report is sent to the backend for the internal stats server.
+        self.timelines = gs_natneg_stats.NatNegTimelines()
+
+        # Clients paired for each port type of a session, with the
+        # NN_CONNECT packets sent to each of them
+        self.natneg_pairs = {}
+
+        # Servers of the clients of each session, by (IP, local address,
+        # game), resolved once per negotiation.
+        self.server_cache = {}
+
+        # The backend is only queried from the reactor's thread pool so keep
+        # as many connections as there are threads.
+        self.server_manager = gs_backend.BackendClientPool(
+            reactor.getThreadPool().max
+        )
+
+    def startProtocol(self):
+        self.socket = self.transport.socket
+        self.write_queue = gs_write_queue.WriteQueue(logger, self.socket)
+
+        self.expire_call = LoopingCall(self.expire_sessions)
+        self.expire_call.start(self.expire_interval, now=False)
+
+        self.report_call = LoopingCall(self.send_report)
+        self.report_call.start(self.report_interval, now=False)
+
+    def datagramReceived(self, recv_data, addr):
         """Handle NAT Negotiation request."""
-        recv_data, socket = self.request
-        addr = self.client_address
+        # Drop the packet before doing any work if the client is flooding
+        if self.rate_limiter is not None and \
+           not self.rate_limiter.allow(addr[0]):
+            return
 
         logger.log(logging.DEBUG, "Connection from %s:%d...", *addr)
-        logger.log(logging.DEBUG, "%s", utils.pretty_print_hex(recv_data))
+        logger.log(logging.DEBUG, "%s", utils.HexDump(recv_data))
 
         # Make sure it's a legal packet
         if not recv_data.startswith(self.nn_magics):
@@ -721,95 +828,147 @@ class GameSpyNatNegUDPServerHandler(SocketServer.BaseRequestHandler):
         # Handle commands
         try:
             command = self.nn_commands.get(recv_data[7], handle_natneg)
-            command(self.server, recv_data, addr, socket)
+            command(self, recv_data, addr, self.socket)
         except:
             logger.log(logging.ERROR, "Failed to handle command!")
             logger.log(logging.ERROR, "%s", traceback.format_exc())
 
+    def get_gameid(self, gameid):
+        """Return the game name used in the stats.
 
-class GameSpyNatNegUDPServer(SocketServer.UDPServer):
-    """GameSpy NAT Negotiation server."""
+        Only the games from gslist.cfg are reported one by one so clients
+        can't add any name to the stats.
+        """
+        if gameid in self.secret_key_list:
+            return gameid
+        return "unknown"
 
-    def __init__(self,
-                 server_address=dwc_config.get_ip_port('GameSpyNatNegServer'),
-                 RequestHandlerClass=GameSpyNatNegUDPServerHandler,
-                 bind_and_activate=True):
-        SocketServer.UDPServer.__init__(self,
-                                        server_address,
-                                        RequestHandlerClass,
-                                        bind_and_activate)
-        self.session_list = {}
-        self.natneg_preinit_session = {}
-        self.secret_key_list = gs_utils.generate_secret_keys("gslist.cfg")
+    def send_report(self):
+        """Send the negotiation stats to the backend."""
+        report = self.timelines.get_report()
+        if not report:
+            return
 
-        self.server_manager = GameSpyServerDatabase(
-            address=dwc_config.get_ip_port('GameSpyManager'),
-            authkey=""
+        d = threads.deferToThread(self.server_manager.send,
+                                  "set_natneg_report", report)
+        d.addErrback(lambda failure: logger.log(
+            logging.ERROR, "Failed to send the stats: %s",
+            failure.getTraceback()
+        ))
+
+    def refresh_deadline(self, deadlines, session_id):
+        """Postpone the expiration of a session."""
+        deadlines.pop(session_id, None)
+        deadlines[session_id] = time.time() + self.session_timeout
+
+    def expire_sessions(self):
+        """Remove the sessions which didn't receive anything for
+        session_timeout seconds."""
+        now = time.time()
+
+        for sessions, deadlines in (
+            (self.session_list, self.session_deadlines),
+            (self.natneg_preinit_session, self.preinit_session_deadlines)
+        ):
+            while deadlines:
+                session_id, deadline = next(deadlines.iteritems())
+                if deadline > now:
+                    break
+
+                del deadlines[session_id]
+                if sessions.pop(session_id, None) is not None:
+                    logger.log(logging.DEBUG,
+                               "Session %d expired", session_id)
+
+                if sessions is self.session_list:
+                    self.natneg_pairs.pop(session_id, None)
+                    self.server_cache.pop(session_id, None)
+                    self.timelines.expire(session_id)
+
+    def get_server_addrs(self, gameid, session_id, *client_sessions):
+        """Get the server address of each client session.
+
+        The servers found are cached until the session expires, only the
+        missing ones are looked up from a thread. Return a Deferred.
+        """
+        cache = self.server_cache.setdefault(session_id, {})
+        keys = [(client_session['addr'][0],
+                 client_session['localaddr'],
+                 client_session['gameid'])
+                for client_session in client_sessions]
+        missing = [(key, client_session)
+                   for key, client_session in zip(keys, client_sessions)
+                   if key not in cache]
+
+        if not missing:
+            return defer.succeed([cache[key] for key in keys])
+
+        def found(servers):
+            servers = dict(zip([key for key, _ in missing], servers))
+            for key, server in servers.items():
+                if server is not None:
+                    cache[key] = server
+            return [cache.get(key, servers.get(key)) for key in keys]
+
+        d = threads.deferToThread(
+            self.lookup_server_addrs, session_id,
+            [client_session for _, client_session in missing]
         )
-        self.server_manager.connect()
-
-        self.write_queue = Queue.Queue()
-        threading.Thread(target=self.write_queue_worker).start()
-
-    def write_queue_send(self, data, address, socket):
-        time.sleep(0.05)
-        socket.sendto(data, address)
-
-    def write_queue_worker(self):
-        while True:
-            data, address, socket = self.write_queue.get()
-            threading.Thread(target=self.write_queue_send,
-                             args=(data, address, socket)).start()
-            self.write_queue.task_done()
-
-    def get_server_info(self, gameid, session_id, client_id):
-        """Get server by public IP."""
-        server = None
-        ip_str = self.session_list[session_id][client_id]['addr'][0]
-        servers = self.server_manager.get_natneg_server(session_id) \
-                                     ._getvalue()
-        
-        if servers is None:
-            return None
-            
-        for console in [False, True]:
-            if server is not None:
-                break
-            ip = str(utils.get_ip_from_str(ip_str, console))
-            server = next((s for s in servers if s['publicip'] == ip), None)
-
-        return server
-
-    def get_server_info_alt(self, gameid, session_id, client_id):
-        """Get server by local address."""
-        server = None
-        ip_str = self.session_list[session_id][client_id]['addr'][0]
-
-        for console in [False, True]:
-            if server is not None:
-                break
-            ip = str(utils.get_ip_from_str(ip_str, console))
-            server = self.server_manager.find_server_by_local_address(
-                ip,
-                self.session_list[session_id][client_id]['localaddr'],
-                self.session_list[session_id][client_id]['gameid']
-            )._getvalue()
-
-        return server
-
-    def get_server_addr(self, gameid, session_id, client_id):
-        """Get server address."""
-        return \
-            self.get_server_info(gameid, session_id, client_id) or \
-            self.get_server_info_alt(gameid, session_id, client_id)
+        d.addCallback(found)
+        return d
+
+    def lookup_server_addrs(self, session_id, client_sessions):
+        """Get the server address of each client session from the backend.
+
+        The servers of the cookie and the servers matching the local
+        address of each client, with both endiannesses, are requested at
+        once. It waits for the backend, it must be called from a thread.
+        """
+        requests = [("get_natneg_server", (session_id,))]
+        client_ips = []
+        for client_session in client_sessions:
+            ips = [str(utils.get_ip_from_str(client_session['addr'][0],
+                                             console))
+                   for console in [False, True]]
+            client_ips.append(ips)
+            requests.extend(
+                ("find_server_by_local_address",
+                 (ip, client_session['localaddr'], client_session['gameid']))
+                for ip in ips
+            )
+
+        results = self.server_manager.call_many(requests)
+        natneg_servers = results[0] or []
+
+        servers = []
+        for i, ips in enumerate(client_ips):
+            # Get server by public IP
+            server = next((s for ip in ips for s in natneg_servers
+                           if s['publicip'] == ip), None)
+
+            # Get server by local address
+            if server is None:
+                server = next((s for s in results[1 + 2 * i:3 + 2 * i]
+                               if s is not None), None)
+
+            servers.append(server)
+
+        return servers
 
 
 class GameSpyNatNegServer(object):
     def start(self):
-        server = GameSpyNatNegUDPServer()
+        address = dwc_config.get_ip_port('GameSpyNatNegServer')
+        reactor.listenUDP(address[1], GameSpyNatNegProtocol(),
+                          interface=address[0])
         logger.log(logging.INFO, "Server is now listening on %s:%d...",
-                   *server.server_address)
-        server.serve_forever()
+                   *address)
+
+        try:
+            if not reactor.running:
+                reactor.run(installSignalHandlers=0)
+        except ReactorAlreadyRunning:
+            pass
 
 
 if __name__ == "__main__":
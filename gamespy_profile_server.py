@@ -23,6 +23,7 @@
 import logging
 import time
 import traceback
+from collections import OrderedDict
 
 from twisted.internet.protocol import Factory
 from twisted.internet.endpoints import serverFromString
@@ -58,6 +59,127 @@ class GameSpyProfileServer(object):
             pass
 
 
+class Presence(object):
+    """Online profiles receiving the status of each online profile.
+
+    A profile's status is sent to the online profiles on its buddy list.
+    The buddy lists of the online profiles are kept in memory with the
+    reverse index (who has a profile on their buddy list) so status updates
+    are sent without querying the database.
+    """
+
+    def __init__(self, sessions):
+        self.sessions = sessions
+
+        # Buddies of each online profile
+        self.buddies = {}
+        # Online profiles having each profile on their buddy list
+        self.listed_by = {}
+        # Online buddies of each online profile
+        self.watchers = {}
+
+    def login(self, profileid, buddies):
+        """Add an online profile, it must be in sessions."""
+        self.set_buddies(profileid, buddies)
+
+        for other in self.listed_by.get(profileid, ()):
+            self.watchers[other].add(profileid)
+
+    def logout(self, profileid):
+        """Remove a profile which went offline."""
+        if profileid not in self.buddies:
+            return
+
+        self.set_buddies(profileid, ())
+        del self.buddies[profileid]
+        del self.watchers[profileid]
+
+        for other in self.listed_by.get(profileid, ()):
+            self.watchers[other].discard(profileid)
+
+    def update(self, profileid, buddies):
+        """Update the buddy list of a profile if it's online."""
+        if profileid in self.buddies:
+            self.set_buddies(profileid, buddies)
+
+    def set_buddies(self, profileid, buddies):
+        new = set(buddies)
+        old = self.buddies.get(profileid, set())
+
+        for buddy in old - new:
+            self.listed_by[buddy].discard(profileid)
+            if not self.listed_by[buddy]:
+                del self.listed_by[buddy]
+
+        for buddy in new - old:
+            self.listed_by.setdefault(buddy, set()).add(profileid)
+
+        self.buddies[profileid] = new
+        self.watchers[profileid] = set(buddy for buddy in new
+                                       if buddy in self.sessions)
+
+    def send(self, profileid, msg):
+        """Send msg to the online buddies of profileid."""
+        for watcher in self.watchers.get(profileid, ()):
+            session = self.sessions.get(watcher)
+            if session is not None:
+                session.transport.write(msg)
+
+
+class BuddyListCache(object):
+    """Buddy lists by profile id.
+
+    The lists are loaded once and updated when buddies are added,
+    authorized or deleted through the cache, so they're always up to date.
+    The lists returned are shared, they must not be modified. The least
+    recently used lists are dropped past size entries.
+    """
+
+    def __init__(self, db, size=10000):
+        self.db = db
+        self.size = size
+        self.lists = OrderedDict()
+
+    def get(self, profileid):
+        """Return the buddy list of profileid, without blocked buddies."""
+        buddies = self.lists.pop(profileid, None)
+        if buddies is None:
+            buddies = self.db.get_buddy_list(profileid)
+            if len(self.lists) >= self.size:
+                self.lists.popitem(last=False)
+
+        # Move it to the end, the least recently used are first
+        self.lists[profileid] = buddies
+        return buddies
+
+    def find(self, profileid, buddy_profileid):
+        """Return the buddy entry of buddy_profileid if it's cached."""
+        return next((buddy for buddy in self.lists.get(profileid, ())
+                     if buddy['buddyProfileId'] == buddy_profileid), None)
+
+    def add_buddy(self, profileid, buddy_profileid):
+        buddy = self.db.add_buddy(profileid, buddy_profileid)
+
+        if profileid in self.lists:
+            self.lists[profileid].append(buddy)
+
+    def auth_buddy(self, profileid, buddy_profileid):
+        self.db.auth_buddy(profileid, buddy_profileid)
+
+        buddy = self.find(profileid, buddy_profileid)
+        if buddy is not None:
+            buddy['status'] = 1
+
+    def delete_buddy(self, profileid, buddy_profileid):
+        self.db.delete_buddy(profileid, buddy_profileid)
+
+        if profileid in self.lists:
+            self.lists[profileid][:] = [
+                buddy for buddy in self.lists[profileid]
+                if buddy['buddyProfileId'] != buddy_profileid
+            ]
+
+
 class PlayerFactory(Factory):
     def __init__(self):
         """Player Factory.
@@ -69,18 +191,23 @@ class PlayerFactory(Factory):
                    "Now listening for connections on %s:%d...",
                    address[0], address[1])
         self.sessions = {}
+        self.presence = Presence(self.sessions)
+        self.buddy_lists = BuddyListCache(gs_database.GamespyDatabase())
 
     def buildProtocol(self, address):
-        return PlayerSession(self.sessions, address)
+        return PlayerSession(self.sessions, self.presence, self.buddy_lists,
+                             address)
 
 
 class PlayerSession(LineReceiver):
-    def __init__(self, sessions, address):
+    def __init__(self, sessions, presence, buddy_lists, address):
         self.setRawMode()  # We're dealing with binary data so set to raw mode
 
         self.db = gs_database.GamespyDatabase()
 
         self.sessions = sessions
+        self.presence = presence
+        self.buddy_lists = buddy_lists
         self.address = address
         # Stores any unparsable/incomplete commands until the next
         # rawDataReceived
@@ -95,6 +222,7 @@ class PlayerSession(LineReceiver):
         self.status = ""
         self.statstring = ""
         self.locstring = ""
+        self.status_message = self.create_status_message()
 
         self.keepalive = int(time.time())
         self.sesskey = ""
@@ -166,13 +294,13 @@ class PlayerSession(LineReceiver):
         try:
             self.log(logging.INFO, "%s", "Client disconnected")
 
-            self.status = "0"
-            self.statstring = "Offline"
-            self.locstring = ""
-            self.send_status_to_friends()
+            # The profile might have logged in again from another session
+            if self.sessions.get(self.profileid) is self:
+                self.set_status("0", "Offline", "")
+                self.send_status_to_friends()
 
-            if self.profileid in self.sessions:
                 del self.sessions[self.profileid]
+                self.presence.logout(self.profileid)
 
             self.db.delete_session(self.sesskey)
             self.log(logging.INFO, "Deleted session %s", self.session)
@@ -289,8 +417,8 @@ class PlayerSession(LineReceiver):
 
             self.sessions[profileid] = self
 
-            self.buddies = self.db.get_buddy_list(self.profileid)
-            self.blocked = self.db.get_blocked_list(self.profileid)
+            self.buddies = self.buddy_lists.get(int(profileid))
+            self.blocked = self.db.get_blocked_list(profileid)
 
             if self.sdkrevision == "11":  # Used in Tatsunoko vs Capcom
                 def make_list(data):
@@ -345,6 +473,8 @@ class PlayerSession(LineReceiver):
             # status updates, so don't make it region specific.
             self.gameid = gsbrcd[:4]
             self.profileid = int(profileid)
+            self.status_message = self.create_status_message()
+            self.presence.login(self.profileid, self.get_buddy_ids())
 
             self.log(logging.DEBUG, "SENDING: %s", msg)
             self.transport.write(bytes(msg))
@@ -464,9 +594,9 @@ class PlayerSession(LineReceiver):
 
     def perform_status(self, data_parsed):
         self.sesskey = data_parsed['sesskey']
-        self.status = data_parsed['__cmd_val__']
-        self.statstring = data_parsed['statstring']
-        self.locstring = data_parsed['locstring']
+        self.set_status(data_parsed['__cmd_val__'],
+                        data_parsed['statstring'],
+                        data_parsed['locstring'])
 
         # Send authorization requests to client
         self.get_buddy_requests()
@@ -482,7 +612,7 @@ class PlayerSession(LineReceiver):
             if "t" in data_parsed:
                 # Send message to the profile id in "t"
                 dest_profileid = int(data_parsed['t'])
-                dest_profile_buddies = self.db.get_buddy_list(dest_profileid)
+                dest_profile_buddies = self.buddy_lists.get(dest_profileid)
                 dest_msg = data_parsed['msg']
 
                 not_buddies = False
@@ -565,7 +695,7 @@ class PlayerSession(LineReceiver):
 
         # Sample:
         # \addbuddy\\sesskey\231601763\newprofileid\476756820\reason\\final\
-        self.buddies = self.db.get_buddy_list(self.profileid)
+        self.buddies = self.buddy_lists.get(self.profileid)
 
         buddy_exists = False
         for buddy in self.buddies:
@@ -574,7 +704,7 @@ class PlayerSession(LineReceiver):
                 break
 
         if not buddy_exists:
-            self.db.add_buddy(self.profileid, newprofileid)
+            self.buddy_lists.add_buddy(self.profileid, newprofileid)
 
             if newprofileid in self.sessions:
                 logger.log(logging.DEBUG,
@@ -585,7 +715,7 @@ class PlayerSession(LineReceiver):
                 # TODO: Add a way to check if a profile id is already a buddy
                 # using SQL
                 other_player_authorized = False
-                target_buddy_list = self.db.get_buddy_list(newprofileid)
+                target_buddy_list = self.buddy_lists.get(newprofileid)
                 logger.log(logging.DEBUG, "%s", target_buddy_list)
                 for buddy in target_buddy_list:
                     if buddy['buddyProfileId'] == self.profileid and \
@@ -607,8 +737,8 @@ class PlayerSession(LineReceiver):
 
                     self.send_bm4(newprofileid)
 
-                    self.db.auth_buddy(newprofileid, self.profileid)
-                    self.db.auth_buddy(self.profileid, newprofileid)
+                    self.buddy_lists.auth_buddy(newprofileid, self.profileid)
+                    self.buddy_lists.auth_buddy(self.profileid, newprofileid)
 
                     self.send_status_to_friends(newprofileid)
                     self.get_status_from_friends(newprofileid)
@@ -622,7 +752,8 @@ class PlayerSession(LineReceiver):
             self.send_status_to_friends(newprofileid)
             self.get_status_from_friends(newprofileid)
 
-        self.buddies = self.db.get_buddy_list(self.profileid)
+        self.buddies = self.buddy_lists.get(self.profileid)
+        self.presence.update(self.profileid, self.get_buddy_ids())
 
     def send_bm4(self, playerid):
         date = int(time.time())
@@ -640,8 +771,10 @@ class PlayerSession(LineReceiver):
         """Sample:
         \delbuddy\\sesskey\61913621\delprofileid\1\final\
         """
-        self.db.delete_buddy(self.profileid, int(data_parsed['delprofileid']))
-        self.buddies = self.db.get_buddy_list(self.profileid)
+        self.buddy_lists.delete_buddy(self.profileid,
+                                      int(data_parsed['delprofileid']))
+        self.buddies = self.buddy_lists.get(self.profileid)
+        self.presence.update(self.profileid, self.get_buddy_ids())
 
     def perform_authadd(self, data_parsed):
         """Authorize the other person's friend request.
@@ -651,20 +784,26 @@ class PlayerSession(LineReceiver):
         \sig\f259f26d3273f8bda23c7c5e4bd8c5aa\final\
         """
         target_profile = int(data_parsed['fromprofileid'])
-        self.db.auth_buddy(target_profile, self.profileid)
+        self.buddy_lists.auth_buddy(target_profile, self.profileid)
         self.get_buddy_authorized()
-        self.buddies = self.db.get_buddy_list(self.profileid)
+        self.buddies = self.buddy_lists.get(self.profileid)
 
         self.send_bm4(target_profile)
 
         self.send_status_to_friends(target_profile)
         self.get_status_from_friends(target_profile)
 
-    def send_status_to_friends(self, buddy_profileid=None):
-        """TODO: Cache buddy list so we don't have to query the
-        database every time."""
-        self.buddies = self.db.get_buddy_list(self.profileid)
+    def get_buddy_ids(self):
+        return [buddy['buddyProfileId'] for buddy in self.buddies]
+
+    def set_status(self, status, statstring, locstring):
+        self.status = status
+        self.statstring = statstring
+        self.locstring = locstring
+        self.status_message = self.create_status_message()
 
+    def create_status_message(self):
+        """Encode the status message sent to the buddies."""
         if self.status == "0" and self.statstring == "Offline":
             # Going offline, don't need to send the other information.
             status_msg = "|s|%s|ss|%s" % (self.status, self.statstring)
@@ -680,24 +819,19 @@ class PlayerSession(LineReceiver):
             ('f', self.profileid),
             ('msg', status_msg),
         ])
+        return bytes(msg)
 
-        buddy_list = self.buddies
-        if buddy_profileid is not None:
-            buddy_list = [{"buddyProfileId": buddy_profileid}]
+    def send_status_to_friends(self, buddy_profileid=None):
+        """Send the status to the online buddies, or to buddy_profileid.
 
-        for buddy in buddy_list:
-            if buddy['buddyProfileId'] in self.sessions:
-                # self.log(logging.DEBUG,
-                #          "Sending status to buddy id %s (%s:%d): %s",
-                #          str(buddy['buddyProfileId']),
-                #          self.sessions[
-                #              buddy['buddyProfileId']
-                #          ].address.host,
-                #          self.sessions[
-                #              buddy['buddyProfileId']
-                #          ].address.port, msg)
-                self.sessions[buddy['buddyProfileId']].transport \
-                                                      .write(bytes(msg))
+        The message is encoded once per status change and the online
+        buddies are known by the presence, the database isn't queried.
+        """
+        if buddy_profileid is None:
+            self.presence.send(self.profileid, self.status_message)
+        elif buddy_profileid in self.sessions:
+            self.sessions[buddy_profileid].transport \
+                                          .write(self.status_message)
 
     def get_status_from_friends(self, buddy_profileid=None):
         """This will be called when the player logs in.
@@ -706,7 +840,7 @@ class PlayerSession(LineReceiver):
         see if anyone is online. If they are online, make them send an update
         to the calling client.
         """
-        self.buddies = self.db.get_buddy_list(self.profileid)
+        self.buddies = self.buddy_lists.get(self.profileid)
 
         buddy_list = self.buddies
         if buddy_profileid is not None:
@@ -718,24 +852,17 @@ class PlayerSession(LineReceiver):
 
             if buddy['buddyProfileId'] in self.sessions and \
                self.sessions[buddy['buddyProfileId']].gameid == self.gameid:
-                status_msg = "|s|%s|ss|%s|ls|%s|ip|%d|p|0|qm|0" % (
-                    self.sessions[buddy['buddyProfileId']].status,
-                    self.sessions[buddy['buddyProfileId']].statstring,
-                    self.sessions[buddy['buddyProfileId']].locstring,
-                    self.get_ip_as_int(self.sessions[
-                        buddy['buddyProfileId']
-                    ].address.host))
+                # Online buddies already have their status message encoded
+                msg = self.sessions[buddy['buddyProfileId']].status_message
             else:
-                status_msg = "|s|0|ss|Offline"
-
-            msg = gs_query.create_gamespy_message([
-                ('__cmd__', "bm"),
-                ('__cmd_val__', "100"),
-                ('f', buddy['buddyProfileId']),
-                ('msg', status_msg),
-            ])
+                msg = bytes(gs_query.create_gamespy_message([
+                    ('__cmd__', "bm"),
+                    ('__cmd_val__', "100"),
+                    ('f', buddy['buddyProfileId']),
+                    ('msg', "|s|0|ss|Offline"),
+                ]))
 
-            self.transport.write(bytes(msg))
+            self.transport.write(msg)
 
     def get_buddy_authorized(self):
         buddies = self.db.buddy_need_auth_message(self.profileid)
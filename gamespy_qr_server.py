@@ -24,31 +24,55 @@ Query and Reporting:
 http://docs.poweredbygamespy.com/wiki/Query_and_Reporting_Overview
 """
 
+import errno
+import heapq
 import logging
+import multiprocessing
 import select
 import socket
 import struct
+import sys
 import threading
 import time
-import Queue
 import traceback
 
-from multiprocessing.managers import BaseManager
-
+import gamespy.gs_backend as gs_backend
 import gamespy.gs_utility as gs_utils
 import gamespy.gs_database as gs_database
+import gamespy.gs_rate_limit as gs_rate_limit
+import gamespy.gs_write_queue as gs_write_queue
 import other.utils as utils
 import dwc_config
 from gamespy_server_browser_server import GameSpyServerBrowserServer
 
 logger = dwc_config.get_logger('GameSpyQRServer')
 
+# Python 2 doesn't define it, several processes can bind the same port on
+# Linux when it's set.
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT",
+                       15 if sys.platform.startswith("linux") else None)
+
+# The socket is blocking so replies are never dropped when the send buffer
+# is full, packets are received without blocking with this flag. Platforms
+# without it check if a packet is waiting first.
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
 
-class GameSpyServerDatabase(BaseManager):
-    pass
+# Replies to availability checks, by status:
+#  - 0: Available
+#  - 1: Unavailable
+#  - 2: Temporarily unavailable
+AVAILABLE_REPLIES = {
+    status: '\xfe\xfd\x09\x00\x00\x00' + chr(status)
+    for status in (0, 1, 2)
+}
 
 
 class GameSpyQRServer(object):
+    # Maximum number of packets handled between keepalive checks
+    recv_batch_size = 256
+    # Interval between reports of the availability checks, in seconds
+    available_stats_interval = 60
+
     class Session(object):
         def __init__(self, address):
             self.session = ""
@@ -56,17 +80,76 @@ class GameSpyQRServer(object):
             self.secretkey = ""  # Parse gslist.cfg later
             self.sent_challenge = False
             self.heartbeat_data = None
+            # Last heartbeat sent to the backend, with the console
+            self.last_update = None
+            self.last_update_time = 0
             self.address = address
             self.console = 0
+            self.console_pending = False
+            # Heartbeat held until the console is known
+            self.pending_update = None
             self.playerid = 0
             self.ingamesn = None
 
             self.gamename = ""
             self.keepalive = -1
 
-    def __init__(self):
+    def __init__(self, worker_id=None, packet_count=None):
         self.sessions = {}
 
+        # When running several workers, each one has its own sessions. The
+        # kernel sends the packets of a client to the same worker.
+        self.worker_id = worker_id
+        self.packet_count = packet_count
+
+        # Sessions are removed when they haven't sent anything for a while.
+        # The heap contains (deadline, session_id, session) entries. Entries
+        # aren't updated when a session sends something, only when they're
+        # due, so the heap has about one entry per session.
+        self.keepalive_heap = []
+        # Time of the last check, to notice when the clock goes back
+        self.keepalive_last_check = 0
+
+        # Sessions waiting for their profile to know their console
+        self.console_pending_sessions = set()
+        self.keepalive_timeout = dwc_config.get_int(
+            'GameSpyQRServer', 'KeepaliveTimeout', 61
+        )
+        self.keepalive_timeouts = dwc_config.get_int_options(
+            'GameSpyQRServerKeepaliveTimeout'
+        )
+        self.keepalive_min_timeout = min(
+            [self.keepalive_timeout] + self.keepalive_timeouts.values()
+        )
+
+        # Unchanged heartbeats are still sent to the backend this often, in
+        # case it lost its server list
+        self.heartbeat_refresh = dwc_config.get_int(
+            'GameSpyQRServer', 'HeartbeatRefresh', 60
+        )
+
+        # Availability checks are answered with the reply of their game's
+        # status, games are available unless configured otherwise.
+        self.available_replies = {}
+        for gamename, status in dwc_config.get_int_options(
+                'GameSpyQRServerAvailability'
+        ).items():
+            if status not in AVAILABLE_REPLIES:
+                logger.log(logging.ERROR,
+                           "Invalid availability status %d for %s,"
+                           " using 0 (available)", status, gamename)
+                status = 0
+            self.available_replies[gamename] = AVAILABLE_REPLIES[status]
+        self.available_counts = {}
+        self.available_next_stats = \
+            time.time() + self.available_stats_interval
+
+        # Packets are dropped before creating any session when their source
+        # IP sends too many of them.
+        self.rate_limiter = gs_rate_limit.create_rate_limiter(
+            'GameSpyQRServer', logger
+        )
+
         # Generate a dictionary "secret_key_list" containing the secret game
         # keys associated with their game IDs. The dictionary key will be the
         # game's ID, and the value will be the secret key.
@@ -74,9 +157,6 @@ class GameSpyQRServer(object):
         # self.log(logging.DEBUG, address, session_id,
         #          "Generated list of secret game keys...")
 
-        GameSpyServerDatabase.register("update_server_list")
-        GameSpyServerDatabase.register("delete_server")
-
     def log(self, level, address, session_id, msg, *args, **kwargs):
         """TODO: Use logger format"""
         if address is None:
@@ -93,14 +173,12 @@ class GameSpyQRServer(object):
 
     def start(self):
         try:
-            manager_address = dwc_config.get_ip_port('GameSpyManager')
-            manager_password = ""
-
-            self.server_manager = GameSpyServerDatabase(
-                address=manager_address,
-                authkey=manager_password
+            # Workers can be started before the backend
+            self.server_manager = gs_backend.BackendClient()
+            self.server_manager.connect(
+                0 if self.worker_id is None else 30
             )
-            self.server_manager.connect()
+            self.backend_connections = self.server_manager.connections
 
             # Start QR server
             # Accessible to outside connections (use this if you don't know
@@ -108,8 +186,9 @@ class GameSpyQRServer(object):
             address = dwc_config.get_ip_port('GameSpyQRServer')
 
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if self.worker_id is not None:
+                self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
             self.socket.bind(address)
-            self.socket.setblocking(0)
 
             logger.log(logging.INFO,
                        "Server is now listening on %s:%s...",
@@ -117,48 +196,85 @@ class GameSpyQRServer(object):
 
             # Dependencies! I don't really like this solution but it's easier
             # than trying to manage it another way.
-            server_browser_server = GameSpyServerBrowserServer(self)
-            server_browser_server_thread = threading.Thread(
-                target=server_browser_server.start
-            )
-            server_browser_server_thread.start()
+            # Only the first worker runs the server browser, any worker can
+            # forward its messages since they share the same port.
+            if not self.worker_id:
+                server_browser_server = GameSpyServerBrowserServer(self)
+                server_browser_server_thread = threading.Thread(
+                    target=server_browser_server.start
+                )
+                server_browser_server_thread.start()
 
-            self.write_queue = Queue.Queue()
-            self.db = gs_database.GamespyDatabase()
-            threading.Thread(target=self.write_queue_worker).start()
+            self.write_queue = gs_write_queue.WriteQueue(logger, self.socket)
+            self.profile_cache = gs_database.ProfileCache()
+
+            if hasattr(select, "epoll"):
+                poller = select.epoll()
+                poller.register(self.socket.fileno(), select.EPOLLIN)
+                wait = lambda timeout: poller.poll(timeout)
+            else:
+                wait = lambda timeout: select.select([self.socket], [], [],
+                                                     timeout)
 
             while True:
-                ready = select.select([self.socket], [], [], 15)
+                # Wake up sooner when heartbeats are held until profiles
+                # are loaded
+                wait(1 if self.console_pending_sessions else 15)
+
+                # Handle every packet received since the last wake-up
+                packets = self.recv_batch()
+                if self.packet_count is not None:
+                    self.packet_count.value += len(packets)
+
+                for recv_data, address in packets:
+                    if self.rate_limiter is not None and \
+                       not self.rate_limiter.allow(address[0]):
+                        continue
 
-                if ready[0]:
                     try:
-                        recv_data, address = self.socket.recvfrom(2048)
                         self.handle_packet(self.socket, recv_data, address)
                     except:
                         logger.log(logging.ERROR,
                                    "Failed to handle client: %s",
                                    traceback.format_exc())
 
+                self.send_pending_updates()
                 self.keepalive_check()
+                self.flush_updates()
+
+                if time.time() >= self.available_next_stats:
+                    self.log_available_stats()
         except:
             logger.log(logging.ERROR,
                        "Unknown exception: %s",
                        traceback.format_exc())
 
-    def write_queue_send(self, data, address):
-        time.sleep(0.05)
-        self.socket.sendto(data, address)
+    def recv_batch(self):
+        """Read the available packets, at most recv_batch_size of them."""
+        packets = []
 
-    def write_queue_worker(self):
-        while True:
-            data, address = self.write_queue.get()
-            threading.Thread(target=self.write_queue_send,
-                             args=(data, address)).start()
-            self.write_queue.task_done()
+        for _ in xrange(self.recv_batch_size):
+            if not MSG_DONTWAIT and \
+               not select.select([self.socket], [], [], 0)[0]:
+                break
+
+            try:
+                packets.append(self.socket.recvfrom(2048, MSG_DONTWAIT))
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+
+                # Windows reports ICMP port unreachable messages from
+                # previous sends as errors
+                logger.log(logging.DEBUG,
+                           "Failed to receive packet: %s", e)
+
+        return packets
 
     def update_server_list(self, session_id, k):
         if "statechanged" in k and k['statechanged'] == "2":  # Close server
-            self.server_manager.delete_server(k['gamename'], session_id)
+            self.server_manager.queue("delete_server",
+                                      k['gamename'], session_id)
 
             if session_id in self.sessions:
                 del self.sessions[session_id]
@@ -172,15 +288,49 @@ class GameSpyQRServer(object):
             # dwc_mtype = 3 is used when looking for a friends only game
             # (possibly other uses too).
 
+            # The public IP and the endianness of some fields depend on the
+            # console, the server is registered once it's known.
+            if self.sessions[session_id].console_pending:
+                self.sessions[session_id].pending_update = k
+                self.log(logging.DEBUG, None, session_id,
+                         "Console unknown, holding update.")
+                return
+            self.sessions[session_id].pending_update = None
+
+            # Heartbeats received while the console was unknown don't have
+            # their public IP yet
+            if k.get('publicip') == "0":
+                k['publicip'] = self.get_public_ip(
+                    self.sessions[session_id].address,
+                    self.sessions[session_id].console
+                )
+
+            # Idle hosts keep sending the same heartbeat, the backend only
+            # needs to know when something changed.
+            now = time.time()
+            update = (k, self.sessions[session_id].console)
+            refresh = self.sessions[session_id].last_update_time + \
+                self.heartbeat_refresh
+            if update == self.sessions[session_id].last_update and \
+               now < refresh:
+                self.log(logging.DEBUG, None, session_id,
+                         "Heartbeat didn't change, skipping update.")
+                return
+
             # Some memory could be saved by clearing out any unwanted fields
             # from k before sending.
-            self.server_manager.update_server_list(
+            # The result isn't needed so don't wait for the backend, the
+            # updates of a batch of packets are sent together.
+            self.server_manager.queue(
+                "update_server_list",
                 k['gamename'], session_id, k,
                 self.sessions[session_id].console
-            )._getvalue()
+            )
 
             if session_id in self.sessions:
                 self.sessions[session_id].gamename = k['gamename']
+                self.sessions[session_id].last_update = update
+                self.sessions[session_id].last_update_time = now
 
     def handle_packet(self, socket, recv_data, address):
         """Tetris DS overlay 10 @ 02144184 - Handle responses back to server.
@@ -284,26 +434,29 @@ class GameSpyQRServer(object):
         https://github.com/sfcspanky/Openspy-Core/tree/master/qr
         Use as reference.
         """
-        session_id = None
-        if recv_data[0] != '\x09':
+        if recv_data[0] == '\x09':  # Available
             # Don't add a session if the client is trying to check if the game
             # is available or not
-            session_id = struct.unpack("<I", recv_data[1:5])[0]
-            session_id_raw = recv_data[1:5]
-            if session_id not in self.sessions:
-                # Found a new session, add to session list
-                self.sessions[session_id] = self.Session(address)
-                self.sessions[session_id].session = session_id
-                self.sessions[session_id].keepalive = int(time.time())
-                self.sessions[session_id].disconnected = False
-
-            if session_id in self.sessions and \
-               self.sessions[session_id].disconnected:
-                return
+            self.handle_available(recv_data, address)
+            return
+
+        session_id = struct.unpack("<I", recv_data[1:5])[0]
+        session_id_raw = recv_data[1:5]
+        if session_id not in self.sessions:
+            # Found a new session, add to session list
+            self.sessions[session_id] = self.Session(address)
+            self.sessions[session_id].session = session_id
+            self.sessions[session_id].keepalive = int(time.time())
+            self.sessions[session_id].disconnected = False
+            self.schedule_keepalive_check(self.sessions[session_id])
 
-            if session_id in self.sessions:
-                # Make sure the server doesn't get removed
-                self.sessions[session_id].keepalive = int(time.time())
+        if session_id in self.sessions and \
+           self.sessions[session_id].disconnected:
+            return
+
+        if session_id in self.sessions:
+            # Make sure the server doesn't get removed
+            self.sessions[session_id].keepalive = int(time.time())
 
         # Handle commands
         if recv_data[0] == '\x00':  # Query
@@ -345,7 +498,9 @@ class GameSpyQRServer(object):
                 # Failed the challenge, request another during the next
                 # heartbeat
                 self.sessions[session_id].sent_challenge = False
-                self.server_manager.delete_server(
+                self.sessions[session_id].last_update = None
+                self.server_manager.queue(
+                    "delete_server",
                     self.sessions[session_id].gamename,
                     session_id
                 )
@@ -373,26 +528,23 @@ class GameSpyQRServer(object):
                 #          d[i], d[i + 1])
                 k[d[i]] = d[i+1]
 
-            if self.sessions[session_id].ingamesn is not None:
-                if "gamename" in k and "dwc_pid" in k:
-                    try:
-                        profile = self.db.get_profile_from_profileid(
-                            k['dwc_pid']
-                        )
-                        naslogin = self.db.get_nas_login_from_userid(
-                            profile['userid']
-                        )
-                        # Convert to string from unicode (which is just a
-                        # base64 string anyway)
+            if self.sessions[session_id].ingamesn is None and \
+               "gamename" in k and "dwc_pid" in k:
+                try:
+                    # The profile is loaded in the background, the name is
+                    # added to the next heartbeats once it's cached.
+                    profile = self.profile_cache.get(k['dwc_pid'])
+                    if profile is not None and \
+                       profile['ingamesn'] is not None:
                         self.sessions[session_id].ingamesn = \
-                            str(naslogin['ingamesn'])
-                    except Exception, e:
-                        # If the game doesn't have, don't worry about it.
-                        pass
+                            profile['ingamesn']
+                except Exception, e:
+                    # If the game doesn't have, don't worry about it.
+                    pass
 
-                if self.sessions[session_id].ingamesn is not None and \
-                   "ingamesn" not in k:
-                    k['ingamesn'] = self.sessions[session_id].ingamesn
+            if self.sessions[session_id].ingamesn is not None and \
+               "ingamesn" not in k:
+                k['ingamesn'] = self.sessions[session_id].ingamesn
 
             if "gamename" in k:
                 if k['gamename'] in self.secret_key_list:
@@ -429,32 +581,23 @@ class GameSpyQRServer(object):
                         found_console = True
 
                 if found_console is False:
-                    # Couldn't detect game, try to get it from the database
-                    # Try a 3 times before giving up
-                    for i in range(0, 3):
-                        try:
-                            profile = self.db.get_profile_from_profileid(
-                                self.sessions[session_id].playerid
-                            )
-
-                            if "console" in profile:
-                                self.sessions[session_id].console = \
-                                    profile['console']
-
-                            break
-                        except:
-                            time.sleep(0.5)
-
-            if 'publicip' in k and k['publicip'] == "0":
+                    # Couldn't detect game, get it from the profile
+                    self.sessions[session_id].console_pending = True
+                    self.console_pending_sessions.add(session_id)
+
+            if self.sessions[session_id].console_pending:
+                self.load_console(session_id)
+
+            # The public IP is computed once the console is known, the
+            # heartbeat isn't sent to the backend until then.
+            if 'publicip' in k and k['publicip'] == "0" and \
+               not self.sessions[session_id].console_pending:
                 # and k['dwc_hoststate'] == "2":
                 # When dwc_hoststate == 2 then it doesn't send an IP,
                 # so calculate it ourselves
-                be = self.sessions[session_id].console != 0
-                k['publicip'] = str(utils.get_ip(
-                    bytearray([int(x) for x in address[0].split('.')]),
-                    0,
-                    be
-                ))
+                k['publicip'] = self.get_public_ip(
+                    address, self.sessions[session_id].console
+                )
 
             if 'publicport' in k and \
                'localport' in k and \
@@ -523,16 +666,6 @@ class GameSpyQRServer(object):
                      address[0], address[1])
             self.sessions[session_id].keepalive = int(time.time())
 
-        elif recv_data[0] == '\x09':  # Available
-            # Availability check only sent to *.available.gs.nintendowifi.net
-            self.log(logging.DEBUG, address, session_id,
-                     "Received availability request for '%s' from %s:%s...",
-                     recv_data[5: -1], address[0], address[1])
-            self.write_queue.put((
-                bytearray([0xfe, 0xfd, 0x09, 0x00, 0x00, 0x00, 0x00]),
-                address
-            ))
-
         elif recv_data[0] == '\x0a':  # Client Registered
             # Only sent to client, never received?
             self.log(logging.WARNING, address, session_id,
@@ -548,36 +681,245 @@ class GameSpyQRServer(object):
                      "%s",
                      utils.pretty_print_hex(recv_data))
 
+    def flush_updates(self):
+        """Send the queued updates to the backend.
+
+        If the connection to the backend was opened again, it might have
+        lost its server list, the next heartbeats are sent even if they
+        didn't change.
+        """
+        try:
+            self.server_manager.flush()
+        except gs_backend.BackendError as e:
+            logger.log(logging.ERROR,
+                       "Failed to send updates to the backend: %s", e)
+
+        if self.server_manager.connections != self.backend_connections:
+            self.backend_connections = self.server_manager.connections
+            for session in self.sessions.values():
+                session.last_update = None
+
+    def get_public_ip(self, address, console):
+        """Return the public IP of address as sent by console."""
+        be = console != 0
+        return str(utils.get_ip(
+            bytearray([int(x) for x in address[0].split('.')]),
+            0,
+            be
+        ))
+
+    def load_console(self, session_id):
+        """Set the console of a session once its profile is cached.
+
+        The profile is loaded in the background, return False until then.
+        """
+        session = self.sessions[session_id]
+        profile = self.profile_cache.get(session.playerid)
+        if profile is None:
+            return False
+
+        session.console_pending = False
+        self.console_pending_sessions.discard(session_id)
+        if profile['console'] is not None:
+            session.console = profile['console']
+
+        return True
+
+    def send_pending_updates(self):
+        """Send the heartbeats held until their session's console was
+        known."""
+        for session_id in list(self.console_pending_sessions):
+            session = self.sessions.get(session_id)
+            if session is None or not session.console_pending:
+                self.console_pending_sessions.discard(session_id)
+                continue
+
+            if not self.load_console(session_id) or \
+               session.pending_update is None:
+                continue
+
+            self.update_server_list(session_id, session.pending_update)
+
+    def handle_available(self, recv_data, address):
+        """Answer an availability check (0x09) right away.
+
+        Every console sends one when connecting, to the
+        *.available.gs.nintendowifi.net server. They are counted per game and
+        reported every available_stats_interval seconds instead of being
+        logged one by one.
+        """
+        gamename = recv_data[5:].split('\0', 1)[0]
+        reply = self.available_replies.get(gamename, AVAILABLE_REPLIES[0])
+
+        # Don't let clients add any name to the counts
+        if gamename not in self.secret_key_list:
+            gamename = "unknown"
+        self.available_counts[gamename] = \
+            self.available_counts.get(gamename, 0) + 1
+
+        try:
+            self.socket.sendto(reply, address)
+        except socket.error as e:
+            logger.log(logging.DEBUG,
+                       "Failed to answer availability check from %s:%d: %s",
+                       address[0], address[1], e)
+
+    def log_available_stats(self):
+        """Log the availability checks of the last interval."""
+        if self.available_counts:
+            counts = sorted(self.available_counts.items(),
+                            key=lambda item: item[1], reverse=True)
+            logger.log(logging.INFO,
+                       "%d availability checks: %s",
+                       sum(self.available_counts.values()),
+                       ", ".join("%s %d" % item for item in counts))
+
+        self.available_counts = {}
+        self.available_next_stats = \
+            time.time() + self.available_stats_interval
+
+    def get_keepalive_timeout(self, gamename):
+        return self.keepalive_timeouts.get(gamename, self.keepalive_timeout)
+
+    def schedule_keepalive_check(self, session):
+        # The game isn't always known yet, so check the session as soon as
+        # it could time out.
+        heapq.heappush(self.keepalive_heap, (
+            session.keepalive + self.keepalive_min_timeout,
+            session.session,
+            session
+        ))
+
     def keepalive_check(self):
         # self.log(logging.DEBUG, None, session_id,
         #          "Keep alive check on %d sessions",
         #          len(self.sessions))
 
-        pruned = []
         now = int(time.time())
 
-        for session_id in self.sessions:
-            delta = now - self.sessions[session_id].keepalive
-            timeout = 61  # Remove clients that haven't responded in x seconds
+        if now < self.keepalive_last_check:
+            # The clock went back, the deadlines in the heap are too far.
+            # Sessions seen "in the future" are removed and the others are
+            # scheduled again.
+            self.keepalive_heap = []
+            for session in self.sessions.values():
+                if session.keepalive > now:
+                    self.remove_expired_session(session, now)
+                else:
+                    self.schedule_keepalive_check(session)
+        self.keepalive_last_check = now
 
-            if delta < 0 or delta >= timeout:
-                pruned.append(session_id)
-                self.server_manager.delete_server(
-                    self.sessions[session_id].gamename,
-                    self.sessions[session_id].session
-                )
-                self.log(logging.DEBUG, None, session_id,
-                         "Keep alive check removed %s:%s for game %s."
-                         " Client hasn't responded in %d seconds.",
-                         self.sessions[session_id].address[0],
-                         self.sessions[session_id].address[1],
-                         self.sessions[session_id].gamename,
-                         delta)
+        while self.keepalive_heap and self.keepalive_heap[0][0] <= now:
+            _, session_id, session = heapq.heappop(self.keepalive_heap)
+
+            if self.sessions.get(session_id) is not session:
+                # The session was already removed
+                continue
+
+            # Remove clients that haven't responded in x seconds
+            timeout = self.get_keepalive_timeout(session.gamename)
+            deadline = session.keepalive + timeout
+
+            if deadline > now:
+                # The session hasn't timed out yet
+                heapq.heappush(self.keepalive_heap,
+                               (deadline, session_id, session))
+                continue
 
-        for session_id in pruned:
-            del self.sessions[session_id]
+            self.remove_expired_session(session, now)
+
+    def remove_expired_session(self, session, now):
+        self.server_manager.queue(
+            "delete_server",
+            session.gamename,
+            session.session
+        )
+        self.log(logging.DEBUG, None, session.session,
+                 "Keep alive check removed %s:%s for game %s."
+                 " Client hasn't responded in %d seconds.",
+                 session.address[0],
+                 session.address[1],
+                 session.gamename,
+                 now - session.keepalive)
+
+        del self.sessions[session.session]
+
+
+def run_worker(worker_id, packet_count):
+    GameSpyQRServer(worker_id, packet_count).start()
+
+
+class GameSpyQRServerWorkers(object):
+    """Run the QR server in several processes sharing the same port.
+
+    The number of processes is set by the Workers option. With a single
+    worker, the QR server runs in the calling thread like before.
+    """
+
+    def __init__(self):
+        self.workers = dwc_config.get_int('GameSpyQRServer', 'Workers', 1)
+        self.stats_interval = dwc_config.get_int(
+            'GameSpyQRServer', 'WorkersStatsInterval', 60
+        )
+        self.processes = []
+        self.packet_counts = []
+
+        if self.workers > 1 and SO_REUSEPORT is None:
+            logger.log(logging.WARNING,
+                       "SO_REUSEPORT isn't available, using a single"
+                       " QR worker instead of %d.",
+                       self.workers)
+            self.workers = 1
+
+    def fork(self):
+        """Start the worker processes.
+
+        It must be done before starting any thread, only the calling thread
+        exists in the new processes.
+        """
+        if self.workers <= 1:
+            return
+
+        for worker_id in range(self.workers):
+            packet_count = multiprocessing.Value('L', 0, lock=False)
+            process = multiprocessing.Process(target=run_worker,
+                                              args=(worker_id, packet_count))
+            process.daemon = True
+            process.start()
+
+            self.processes.append(process)
+            self.packet_counts.append(packet_count)
+
+        logger.log(logging.INFO,
+                   "Started %d QR workers.", len(self.processes))
+
+    def start(self):
+        if not self.processes:
+            GameSpyQRServer().start()
+            return
+
+        # Report the packet rate of each worker
+        last_counts = [0] * len(self.processes)
+        while True:
+            time.sleep(self.stats_interval)
+
+            for worker_id, process in enumerate(self.processes):
+                count = self.packet_counts[worker_id].value
+                rate = (count - last_counts[worker_id]) / \
+                    float(self.stats_interval)
+                last_counts[worker_id] = count
+
+                if process.is_alive():
+                    logger.log(logging.INFO,
+                               "QR worker %d (pid %d): %.1f packets/s",
+                               worker_id, process.pid, rate)
+                else:
+                    logger.log(logging.ERROR,
+                               "QR worker %d (pid %d) exited with code %s",
+                               worker_id, process.pid, process.exitcode)
 
 
 if __name__ == "__main__":
-    qr_server = GameSpyQRServer()
+    qr_server = GameSpyQRServerWorkers()
+    qr_server.fork()
     qr_server.start()
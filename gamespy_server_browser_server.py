@@ -24,20 +24,24 @@ https://github.com/sfcspanky/Openspy-Core/blob/master/serverbrowsing/
 
 import logging
 import socket
+import threading
 import traceback
 
+from collections import OrderedDict
+
 from twisted.internet.protocol import Factory
 from twisted.internet.endpoints import serverFromString
 from twisted.protocols.basic import LineReceiver
+from twisted.internet import defer
 from twisted.internet import reactor
+from twisted.internet import threads
 from twisted.internet.error import ReactorAlreadyRunning
 
+import gamespy.gs_backend as gs_backend
 import gamespy.gs_utility as gs_utils
 import other.utils as utils
 import dwc_config
 
-from multiprocessing.managers import BaseManager
-
 logger = dwc_config.get_logger('GameSpyServerBrowserServer')
 
 
@@ -52,18 +56,41 @@ class ServerListFlags:
     HAS_FULL_RULES_FLAG = 128
 
 
-class GameSpyServerDatabase(BaseManager):
-    pass
+address = dwc_config.get_ip_port('GameSpyServerBrowserServer')
 
-GameSpyServerDatabase.register("get_server_list")
-GameSpyServerDatabase.register("modify_server_list")
-GameSpyServerDatabase.register("find_servers")
-GameSpyServerDatabase.register("find_server_by_address")
-GameSpyServerDatabase.register("add_natneg_server")
-GameSpyServerDatabase.register("get_natneg_server")
-GameSpyServerDatabase.register("delete_natneg_server")
 
-address = dwc_config.get_ip_port('GameSpyServerBrowserServer')
+class ServerListCache(object):
+    """Server lists recently sent to clients.
+
+    Clients of the same game often send identical server list requests
+    within a short time. The server list data, before the client address is
+    added and before encryption, is cached by request along with the
+    generation of the game's server list. An entry is only used while the
+    backend returns the same generation for that game.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] != generation:
+                return None
+
+            # Move it to the end, the least recently used are first
+            self.entries[key] = entry
+            return entry[1]
+
+    def set(self, key, generation, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (generation, value)
+
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
 
 
 class GameSpyServerBrowserServer(object):
@@ -92,15 +119,24 @@ class SessionFactory(Factory):
 
         # TODO: Prune server cache at some point
         self.server_cache = {}
+        self.server_list_cache = ServerListCache()
         self.qr = qr
 
+        # Backend connections shared by every session. The backend is only
+        # queried from the reactor's thread pool so keep as many connections
+        # as there are threads.
+        self.server_manager = gs_backend.BackendClientPool(
+            reactor.getThreadPool().max
+        )
+
     def buildProtocol(self, address):
         return Session(address, self.secret_key_list, self.server_cache,
-                       self.qr)
+                       self.qr, self.server_manager, self.server_list_cache)
 
 
 class Session(LineReceiver):
-    def __init__(self, address, secret_key_list, server_cache, qr):
+    def __init__(self, address, secret_key_list, server_cache, qr,
+                 server_manager, server_list_cache):
         self.setRawMode()  # We're dealing with binary data so set to raw mode
         self.address = address
         # Don't waste time parsing every session, so just accept it from
@@ -111,12 +147,12 @@ class Session(LineReceiver):
         self.qr = qr
         self.own_server = None
         self.buffer = []
+        self.server_manager = server_manager
+        self.server_list_cache = server_list_cache
 
-        manager_address = dwc_config.get_ip_port('GameSpyManager')
-        manager_password = ""
-        self.server_manager = GameSpyServerDatabase(address=manager_address,
-                                                    authkey=manager_password)
-        self.server_manager.connect()
+        # Requests needing the backend are handled in a thread, one after
+        # the other, so the reactor doesn't wait for the backend.
+        self.pending = defer.succeed(None)
 
     def log(self, level, msg, *args, **kwargs):
         """TODO: Use logger format"""
@@ -124,6 +160,23 @@ class Session(LineReceiver):
                    self.address.host, self.address.port,
                    *args, **kwargs)
 
+    def run_in_thread(self, func, *args):
+        """Run func in a thread once the previous requests are done."""
+        def run(_):
+            return threads.deferToThread(func, *args)
+
+        def failed(failure):
+            self.log(logging.ERROR,
+                     "Unknown exception: %s",
+                     failure.getTraceback())
+
+        self.pending.addCallback(run)
+        self.pending.addErrback(failed)
+
+    def write(self, data):
+        """Write data to the client from any thread."""
+        reactor.callFromThread(self.transport.write, data)
+
     def rawDataReceived(self, data):
         try:
             # First 2 bytes are the packet size.
@@ -243,7 +296,7 @@ class Session(LineReceiver):
                             output
                         )
 
-                        self.transport.write(bytes(output_enc))
+                        self.write(bytes(output_enc))
 
                         self.log(logging.DEBUG,
                                  "%s",
@@ -252,8 +305,9 @@ class Session(LineReceiver):
                                  "%s",
                                  utils.pretty_print_hex(output))
                     else:
-                        self.find_server(query_game, filter, fields,
-                                         max_servers, game_name, challenge)
+                        self.run_in_thread(self.find_server, query_game,
+                                           filter, fields, max_servers,
+                                           game_name, challenge)
 
                 elif packet[2] == '\x02':  # Send message request
                     packet_len = utils.get_short(packet, 0, True)
@@ -273,7 +327,8 @@ class Session(LineReceiver):
 
                     if packet_len == len(packet):
                         # Contains entire packet, send immediately.
-                        self.forward_data_to_client(packet[9:], dest)
+                        self.run_in_thread(self.forward_data_to_client,
+                                           packet[9:], dest)
                     else:
                         self.log(logging.ERROR,
                                  "%s",
@@ -306,7 +361,7 @@ class Session(LineReceiver):
                                                    max_count)
         return results
 
-    def generate_server_list_header_data(self, address, fields):
+    def generate_server_list_address_data(self, address):
         output = bytearray()
 
         # Write the address
@@ -315,6 +370,11 @@ class Session(LineReceiver):
         # Write the port
         output += utils.get_bytes_from_short(address.port, True)
 
+        return output
+
+    def generate_server_list_fields_data(self, fields):
+        output = bytearray()
+
         # Write number of fields that will be returned.
         key_count = len(fields)
         output += utils.get_bytes_from_short(key_count)
@@ -410,8 +470,41 @@ class Session(LineReceiver):
                                challenge, data)
 
             # Send to client
-            self.transport.write(bytes(data))
+            self.write(bytes(data))
+
+        # The server list doesn't depend on the client, except for its
+        # address at the beginning of the header.
+        key = (query_game, filter,
+               fields if isinstance(fields, basestring) else tuple(fields),
+               max_servers)
+        generation = self.server_manager.get_generation(query_game)
+        cached = self.server_list_cache.get(key, generation)
+
+        if cached is None:
+            cached = self.generate_server_list(query_game, filter, fields,
+                                               max_servers)
+            self.server_list_cache.set(key, generation, cached)
+        else:
+            self.log(logging.DEBUG,
+                     "Using cached server list for '%s' with the fields '%s'",
+                     filter, fields)
+
+        packets, console = cached
+        if console is not None:
+            self.console = console
+
+        address_data = self.generate_server_list_address_data(self.address)
+        for i, data in enumerate(packets):
+            if i == 0:
+                data = address_data + data
+
+            send_encrypted_data(self, challenge, data)
 
+    def generate_server_list(self, query_game, filter, fields, max_servers):
+        """Return the server list packets and the console of the servers.
+
+        The client address is left out of the first packet.
+        """
         # OpenSpy's max packet length, just go with it for now
         max_packet_length = 256 + 511 + 255
 
@@ -420,19 +513,22 @@ class Session(LineReceiver):
                  "Searching for server matching '%s' with the fields '%s'",
                  filter, fields)
 
-        self.server_list = self.server_manager.find_servers(
+        server_list = self.server_manager.find_servers(
             query_game, filter, fields, max_servers
-        )._getvalue()
+        )
 
         self.log(logging.DEBUG, "%s", "Found server(s):")
-        self.log(logging.DEBUG, "%s", self.server_list)
+        self.log(logging.DEBUG, "%s", server_list)
 
-        if not self.server_list:
-            self.server_list = [{}]
+        if not server_list:
+            server_list = [{}]
 
-        data = self.generate_server_list_header_data(self.address, fields)
-        for i in range(0, len(self.server_list)):
-            server = self.server_list[i]
+        console = None
+        packets = []
+        address_data = self.generate_server_list_address_data(self.address)
+        data = address_data + self.generate_server_list_fields_data(fields)
+        for i in range(0, len(server_list)):
+            server = server_list[i]
 
             if server and fields and 'requested' in server and \
                not server['requested']:
@@ -442,15 +538,15 @@ class Session(LineReceiver):
                 server = {}
 
             if "__console__" in server:
-                self.console = int(server['__console__'])
+                self.console = console = int(server['__console__'])
 
             # Generate binary server list data
             data += self.generate_server_list_data(
-                self.address, fields, server, i >= len(self.server_list)
+                self.address, fields, server, i >= len(server_list)
             )
 
             if len(data) >= max_packet_length:
-                send_encrypted_data(self, challenge, data)
+                packets.append(data)
                 data = bytearray()
 
             # if "publicip" in server and "publicport" in server:
@@ -459,7 +555,10 @@ class Session(LineReceiver):
 
         data += '\0'
         data += utils.get_bytes_from_int(0xffffffff)
-        send_encrypted_data(self, challenge, data)
+        packets.append(data)
+
+        packets[0] = packets[0][len(address_data):]
+        return packets, console
 
     def find_server_in_cache(self, addr, port, console):
         ip = str(utils.get_ip(
@@ -467,8 +566,7 @@ class Session(LineReceiver):
             0,
             console
         ))
-        server = self.server_manager.find_server_by_address(ip,
-                                                            port)._getvalue()
+        server = self.server_manager.find_server_by_address(ip, port)
         self.log(logging.DEBUG,
                  "find_server_in_cache is returning: %s %s",
                  server, ip)
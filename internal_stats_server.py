@@ -21,24 +21,18 @@
 from twisted.web import server, resource
 from twisted.internet import reactor
 from twisted.internet.error import ReactorAlreadyRunning
-from multiprocessing.managers import BaseManager
 import time
 import datetime
 import json
 import logging
 
+import gamespy.gs_backend as gs_backend
 import other.utils as utils
 import dwc_config
 
 logger = dwc_config.get_logger('InternalStatsServer')
 
 
-class GameSpyServerDatabase(BaseManager):
-    pass
-
-GameSpyServerDatabase.register("get_server_list")
-
-
 class StatsPage(resource.Resource):
     """Servers statistics webpage.
 
@@ -63,11 +57,67 @@ class StatsPage(resource.Resource):
     <i>Last updated: %s</i><br>
     </html>"""  # % (self.stats.get_last_update_time())
 
+    natneg_header = """<html>
+    <table border='1'>
+        <tr>
+            <td>Game ID</td><td>Connected</td><td>Failed</td>
+            <td>Unreported</td><td>Time to connect (ms)<br>p50 / p90 / p99</td>
+        </tr>"""
+    natneg_row = """
+        <tr>
+            <td>%s</td>
+            <td><center>%d</center></td>
+            <td><center>%d</center></td>
+            <td><center>%d</center></td>
+            <td><center>%s / %s / %s</center></td>
+        </tr>"""
+    natneg_footer = """</table>
+    <br>
+    <table border='1'>
+        <tr>
+            <td>Cookies</td><td>Servers</td><td>Added</td><td>Deleted</td>
+            <td>Expired</td><td>Evicted</td>
+        </tr>
+        <tr>
+            <td><center>%(cookies)d</center></td>
+            <td><center>%(servers)d</center></td>
+            <td><center>%(added)d</center></td>
+            <td><center>%(deleted)d</center></td>
+            <td><center>%(expired)d</center></td>
+            <td><center>%(evicted)d</center></td>
+        </tr>
+    </table>
+    </html>"""  # % (self.stats.get_natneg_stats())
+
     def __init__(self, stats):
         self.stats = stats
 
+    def render_natneg(self, raw):
+        """NAT negotiation stats of each game."""
+        report = self.stats.get_natneg_report()
+
+        if raw:
+            return json.dumps(report)
+
+        output = self.natneg_header
+        output += "".join(
+            self.natneg_row % (game, entry["connected"], entry["failed"],
+                               entry["unreported"], entry["p50"],
+                               entry["p90"], entry["p99"])
+            for game, entry in sorted(report.items())
+        )
+        output += self.natneg_footer % (self.stats.get_natneg_stats())
+        return output
+
     def render_GET(self, request):
-        if "/".join(request.postpath) == "json":
+        path = "/".join(request.postpath)
+        if path in ("natneg", "natneg/json"):
+            return self.render_natneg(path == "natneg/json")
+
+        if path == "natneg/servers/json":
+            return json.dumps(self.stats.get_natneg_stats())
+
+        if path == "json":
             raw = True
             force_update = True
         else:
@@ -106,6 +156,10 @@ class InternalStatsServer(object):
 
     Running on port 9001 by default: http://127.0.0.1:9001/
     Can be displayed in json format: http://127.0.0.1:9001/json
+    NAT negotiation stats: http://127.0.0.1:9001/natneg
+    (or http://127.0.0.1:9001/natneg/json)
+    NAT negotiation servers kept by the backend, including evictions:
+    http://127.0.0.1:9001/natneg/servers/json
     """
     def __init__(self):
         self.last_update = 0
@@ -115,10 +169,7 @@ class InternalStatsServer(object):
         self.seconds_per_update = 60
 
     def start(self):
-        manager_address = dwc_config.get_ip_port('GameSpyManager')
-        manager_password = ""
-        self.server_manager = GameSpyServerDatabase(address=manager_address,
-                                                    authkey=manager_password)
+        self.server_manager = gs_backend.BackendClient()
         self.server_manager.connect()
 
         site = server.Site(StatsPage(self))
@@ -135,13 +186,18 @@ class InternalStatsServer(object):
            self.next_update - time.time() <= 0:
             self.last_update = time.time()
             self.next_update = time.time() + self.seconds_per_update
-            self.server_list = self.server_manager.get_server_list() \
-                                                  ._getvalue()
+            self.server_list = self.server_manager.get_server_list()
 
             logger.log(logging.DEBUG, "%s", self.server_list)
 
         return self.server_list
 
+    def get_natneg_report(self):
+        return self.server_manager.get_natneg_report()
+
+    def get_natneg_stats(self):
+        return self.server_manager.get_natneg_stats()
+
     def get_last_update_time(self):
         return str(datetime.datetime.fromtimestamp(self.last_update))
 
@@ -24,7 +24,7 @@ from gamespy_player_search_server import GameSpyPlayerSearchServer
 from gamespy_profile_server import GameSpyProfileServer
 from gamespy_backend_server import GameSpyBackendServer
 from gamespy_natneg_server import GameSpyNatNegServer
-from gamespy_qr_server import GameSpyQRServer
+from gamespy_qr_server import GameSpyQRServerWorkers
 from gamespy_server_browser_server import GameSpyServerBrowserServer
 from gamespy_gamestats_server import GameSpyGamestatsServer
 from nas_server import NasServer
@@ -51,9 +51,12 @@ if __name__ == "__main__":
     db.initialize_database()
     db.close()
 
+    # The QR worker processes, if any, must be started before any thread
+    qr_server = GameSpyQRServerWorkers()
+    qr_server.fork()
+
     servers = [
         GameSpyBackendServer,
-        GameSpyQRServer,
         GameSpyProfileServer,
         GameSpyPlayerSearchServer,
         GameSpyGamestatsServer,
@@ -69,3 +72,4 @@ if __name__ == "__main__":
     ]
     for server in servers:
         threading.Thread(target=server().start).start()
+    threading.Thread(target=qr_server.start).start()
@@ -326,6 +326,16 @@ def pretty_print_hex(orig_data, cols=16, sep=' '):
 
     return output
 
+
+class HexDump(object):
+    """Hexadecimal pretty print formatted only when logged."""
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return pretty_print_hex(self.data)
+
+
 # def pretty_print_hex(orig_data, cols=16):
 #    """Takes ~1.5s per characters"""
 #
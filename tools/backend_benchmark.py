@@ -0,0 +1,135 @@
+"""Benchmark the backend server communication.
+
+Compare the number of operations per second going through the backend
+protocol (gamespy.gs_backend) and through a multiprocessing manager, which
+was used previously.
+
+Run it from the root folder:
+    python tools/backend_benchmark.py [servers] [operations]
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+
+from multiprocessing.managers import BaseManager
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import gamespy.gs_backend as gs_backend
+import gamespy_backend_server
+
+MANAGER_ADDRESS = ("127.0.0.1", 27600)
+BACKEND_ADDRESS = ("127.0.0.1", 27601)
+
+FILTER = "dwc_mver = 90 and dwc_pid != 1 and maxplayers = 11 and " \
+         "numplayers < 11 and dwc_mtype = 0 and dwc_hoststate = 2 and " \
+         "dwc_suspend = 0 and (rk = 'vs_%d' and (ev > 4263 or ev <= 5763) " \
+         "and p = 0)"
+FIELDS = ["hostname", "gamename", "numplayers", "maxplayers", "rk", "ev"]
+
+
+class ManagerDatabase(BaseManager):
+    pass
+
+
+def generate_server(i):
+    return {
+        "localip0": "192.168.1.%d" % (i % 256),
+        "localport": "55000",
+        "natneg": "1",
+        "gamename": "mariokartwii",
+        "publicip": str(i),
+        "publicport": "55000",
+        "hostname": "hostname%d" % i,
+        "numplayers": str(i % 12),
+        "maxplayers": "11",
+        "dwc_mver": "90",
+        "dwc_pid": str(i),
+        "dwc_mtype": "0",
+        "dwc_hoststate": "2",
+        "dwc_suspend": "0",
+        "rk": "vs_%d" % (i % 4),
+        "ev": "5000",
+        "p": "0",
+    }
+
+
+def start_servers(backend):
+    for name, method in backend.methods.items():
+        ManagerDatabase.register(name, callable=method)
+
+    manager = ManagerDatabase(address=MANAGER_ADDRESS, authkey="")
+    server = manager.get_server()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    server = gs_backend.BackendServer(BACKEND_ADDRESS, backend.methods,
+                                      gamespy_backend_server.logger)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+def measure(name, count, func):
+    start = time.time()
+    for i in range(count):
+        func(i)
+    elapsed = time.time() - start
+    print "%-40s %10.0f ops/s" % (name, count / elapsed)
+
+
+def main(servers=1000, count=200):
+    gamespy_backend_server.logger.setLevel(logging.WARNING)
+    backend = gamespy_backend_server.GameSpyBackendServer()
+    start_servers(backend)
+
+    manager = ManagerDatabase(address=MANAGER_ADDRESS, authkey="")
+    manager.connect()
+    client = gs_backend.BackendClient(BACKEND_ADDRESS)
+    client.connect()
+
+    for i in range(servers):
+        client.update_server_list("mariokartwii", i, generate_server(i), 1)
+
+    print "%d servers, %d operations" % (servers, count)
+
+    measure("manager update_server_list", count,
+            lambda i: manager.update_server_list(
+                "mariokartwii", i % servers, generate_server(i), 1
+            )._getvalue())
+    measure("backend update_server_list", count,
+            lambda i: client.update_server_list(
+                "mariokartwii", i % servers, generate_server(i), 1
+            ))
+    measure("backend update_server_list (no reply)", count,
+            lambda i: client.send(
+                "update_server_list",
+                "mariokartwii", i % servers, generate_server(i), 1
+            ))
+    # Wait for the requests without replies to be handled
+    client.get_natneg_server(0)
+
+    measure("manager find_servers", count,
+            lambda i: manager.find_servers(
+                "mariokartwii", FILTER % (i % 4), FIELDS, 6
+            )._getvalue())
+    measure("backend find_servers", count,
+            lambda i: client.find_servers(
+                "mariokartwii", FILTER % (i % 4), FIELDS, 6
+            ))
+
+    measure("manager find_server_by_address", count,
+            lambda i: manager.find_server_by_address(
+                str(i % servers), "55000"
+            )._getvalue())
+    measure("backend find_server_by_address", count,
+            lambda i: client.find_server_by_address(
+                str(i % servers), "55000"
+            ))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,78 @@
+"""Benchmark the GameSpy encryption routines.
+
+Run it from the root folder:
+    python tools/crypto_benchmark.py [iterations]
+"""
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import gamespy.gs_utility as gs_utils
+
+# Server list responses are usually a few KB
+PAYLOAD_SIZES = [1024, 4096, 8192, 16384]
+
+
+def random_bytes(size, seed=0):
+    rnd = random.Random(seed)
+    return bytearray(rnd.getrandbits(8) for _ in range(size))
+
+
+def measure(name, size, iterations, func):
+    elapsed = min(timeit.repeat(func, number=iterations, repeat=3))
+    per_call = elapsed / iterations
+    print "%-24s %6d bytes %10.3f ms %10.2f MB/s" % (
+        name, size, per_call * 1000, size / per_call / (1024 * 1024)
+    )
+
+
+def benchmark_enctypex(iterations):
+    enc = gs_utils.EncTypeX()
+
+    for size in PAYLOAD_SIZES:
+        data = random_bytes(size)
+        measure("EncTypeX.encrypt", size, iterations,
+                lambda: enc.encrypt("Yvcjgu", "abcdefgh", data))
+
+
+def benchmark_rc4(iterations):
+    for size in PAYLOAD_SIZES:
+        data = random_bytes(size)
+        measure("rc4_encrypt", size, iterations,
+                lambda: gs_utils.rc4_encrypt("Yvcjgu", data))
+
+    # QR challenges are small and sent for every new session
+    challenge = random_bytes(6)
+    measure("prepare_rc4_base64", len(challenge), iterations * 100,
+            lambda: gs_utils.prepare_rc4_base64("Yvcjgu", challenge))
+
+
+def benchmark_gamestats(iterations):
+    for size in PAYLOAD_SIZES:
+        data = "\\auth\\\\gamename\\" + "a" * (size - 23) + "\\final\\"
+        measure("gamestats_crypt", size, iterations,
+                lambda: gs_utils.gamestats_crypt(data))
+
+
+def benchmark_base64(iterations):
+    for size in PAYLOAD_SIZES:
+        data = str(random_bytes(size))
+        encoded = gs_utils.base64_encode(data)
+        measure("base64_encode", size, iterations * 100,
+                lambda: gs_utils.base64_encode(data))
+        measure("base64_decode", size, iterations * 100,
+                lambda: gs_utils.base64_decode(encoded))
+
+
+def main(iterations=20):
+    benchmark_enctypex(iterations)
+    benchmark_rc4(iterations)
+    benchmark_gamestats(iterations)
+    benchmark_base64(iterations)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,172 @@
+"""Generate QR server traffic to measure how many packets it can handle.
+
+Simulated hosts send heartbeats, answer the server challenges and then send
+keep alives and heartbeats in turn, like games hosting a server do. Every
+AVAILABLE_INTERVAL packets, an availability check is sent instead. The
+server answers each of them so the share of answered availability checks
+estimates how many packets the server handled.
+
+Every packet comes from the same IP, set RateLimit to 0 in the
+[GameSpyQRServer] section so they aren't rate limited.
+
+Start the QR server (and the backend) then run it from the root folder:
+    python tools/qr_load_generator.py [hosts] [duration] [rate]
+
+rate is the number of packets sent per second, 0 sends as fast as possible.
+"""
+
+import errno
+import os
+import select
+import socket
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import gamespy.gs_utility as gs_utils
+import dwc_config
+
+GAMENAME = "mariokartwii"
+AVAILABLE_INTERVAL = 4
+AVAILABLE = '\x09\x00\x00\x00\x00' + GAMENAME + '\x00'
+
+
+class Host(object):
+    def __init__(self, index):
+        self.index = index
+        self.session_id = struct.pack("<I", 0x10000000 + index)
+        self.registered = False
+        self.packets = 0
+
+    def heartbeat(self, statechanged):
+        data = [
+            "localip0", "192.168.%d.%d" % (self.index >> 8 & 0xff,
+                                            self.index & 0xff),
+            "localport", "55000",
+            "natneg", "1",
+            "statechanged", str(statechanged),
+            "gamename", GAMENAME,
+            "publicip", "0",
+            "publicport", "55000",
+            "hostname", "host%d" % self.index,
+            "numplayers", str(self.index % 12),
+            "maxplayers", "11",
+            "dwc_mver", "90",
+            "dwc_pid", str(self.index + 1),
+            "dwc_mtype", "0",
+            "dwc_hoststate", "2",
+            "dwc_suspend", "0",
+            "rk", "vs_%d" % (self.index % 4),
+            "ev", "5000",
+            "p", "0",
+        ]
+        return '\x03' + self.session_id + '\0'.join(data) + '\0\0'
+
+    def keepalive(self):
+        return '\x08' + self.session_id
+
+    def next_packet(self):
+        """Heartbeats until registered, then keep alives and heartbeats."""
+        self.packets += 1
+        if not self.registered:
+            return self.heartbeat(1)
+        if self.packets % 2:
+            return self.keepalive()
+        return self.heartbeat(0)
+
+
+def challenge_response(secretkey, packet):
+    """Answer a challenge (fe fd 01 <session id> <challenge> 00)."""
+    challenge = packet[7:-1]
+    response = gs_utils.prepare_rc4_base64(secretkey, challenge)
+    return '\x01' + packet[3:7] + response + '\0'
+
+
+def main(hosts=1000, duration=10, rate=0):
+    address = dwc_config.get_ip_port('GameSpyQRServer')
+    if address[0] == "0.0.0.0":
+        address = ("127.0.0.1", address[1])
+
+    secretkey = gs_utils.generate_secret_keys("gslist.cfg")[GAMENAME]
+    host_list = [Host(i) for i in range(hosts)]
+    host_by_session = {host.session_id: host for host in host_list}
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(0)
+
+    print "%d hosts, sending to %s:%d for %d seconds" % (
+        hosts, address[0], address[1], duration
+    )
+
+    start = time.time()
+    report = start + 1
+    stats = dict.fromkeys(["sent", "received", "available", "answered"], 0)
+    total = dict(stats)
+    i = 0
+
+    def count(name):
+        stats[name] += 1
+        total[name] += 1
+
+    def print_stats(stats, elapsed):
+        handled = stats["sent"]
+        if stats["available"]:
+            handled = handled * stats["answered"] / stats["available"]
+        print "%10.0f packets/s sent %10.0f packets/s received" \
+              " %10.0f packets/s handled" % (stats["sent"] / elapsed,
+                                             stats["received"] / elapsed,
+                                             handled / elapsed)
+
+    while time.time() < start + duration:
+        now = time.time()
+
+        if not rate or total["sent"] < (now - start) * rate:
+            i += 1
+            if i % AVAILABLE_INTERVAL:
+                packet = host_list[i % hosts].next_packet()
+            else:
+                packet = AVAILABLE
+
+            try:
+                sock.sendto(packet, address)
+                count("sent")
+                if packet is AVAILABLE:
+                    count("available")
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+        else:
+            select.select([sock], [], [], 0.001)
+
+        # Handle the replies
+        while True:
+            try:
+                packet = sock.recv(2048)
+            except socket.error:
+                break
+
+            count("received")
+
+            if packet[2] == '\x01':
+                sock.sendto(challenge_response(secretkey, packet), address)
+                count("sent")
+            elif packet[2] == '\x09':
+                count("answered")
+            elif packet[2] == '\x0a' and packet[3:7] in host_by_session:
+                host_by_session[packet[3:7]].registered = True
+
+        if now >= report:
+            print_stats(stats, 1)
+            stats = dict.fromkeys(stats, 0)
+            report += 1
+
+    print "Average:"
+    print_stats(total, time.time() - start)
+    print "%d/%d hosts registered" % (
+        sum(1 for host in host_list if host.registered), hosts
+    )
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])